@@ -9,10 +9,13 @@ def unzipper(file_path, dirname):
         zf.extractall(dirname)
 
 
-def download_http(url, file_path):
-    r = requests.get(url)
+def download_http(url, file_path, chunk_size=1024 * 1024):
+    r = requests.get(url, stream=True)
+    if r.status_code != 200:
+        return False
     with open(file_path, "wb") as f:
-        f.write(r.content)
+        for chunk in r.iter_content(chunk_size):
+            f.write(chunk)
 
 
 def download(url, file_path):
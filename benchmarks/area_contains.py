@@ -0,0 +1,71 @@
+"""Benchmark of the point in polygon tests of TweetAnalyzer.area_contains.
+
+Loads the countries and continents from PostgreSQL, like Base does, and compares the
+exact matplotlib path test with the lookup grid (methods.geo.AreaGrid) on random
+coordinates. Reports the build time of the grids, mismatches and the speedup. With a
+tolerance, the grids are built from the geometries simplified at that tolerance (as in
+the simplified_areas table) and the number of tests against the exact path is reported.
+
+    python -m benchmarks.area_contains [n_points] [cell_size] [tolerance]
+"""
+import sys
+import time
+import random
+
+from methods import geo
+from geotag.config import AREA_GRID_CELL_SIZE, AREA_SIMPLIFICATION_TOLERANCE, pg
+
+
+def load_areas():
+    areas = {}
+    for table in ('countries', 'continents'):
+        pg.cur.execute(f"SELECT geonameid, ST_AsText(geom) FROM {table}")
+        for geonameid, wkt in pg.cur.fetchall():
+            if wkt:
+                geom = geo.wkt_to_geom(wkt)
+                areas[geonameid] = (geom, geo.PolygonPath(geom))
+    return areas
+
+
+def benchmark(n_points=10000, cell_size=AREA_GRID_CELL_SIZE, tolerance=AREA_SIMPLIFICATION_TOLERANCE):
+    areas = load_areas()
+
+    start = time.perf_counter()
+    grids = {
+        geonameid: geo.AreaGrid(
+            geom.simplify(tolerance, preserve_topology=True) if tolerance else geom,
+            path, cell_size, tolerance
+        )
+        for geonameid, (geom, path) in areas.items()
+    }
+    print(f"built {len(grids)} grids in {time.perf_counter() - start:.1f}s (cell size {cell_size}, tolerance {tolerance})")
+
+    random.seed(0)
+    coordinates = [(random.uniform(-180, 180), random.uniform(-60, 80)) for _ in range(n_points)]
+
+    t_path, t_grid, mismatches = 0, 0, 0
+    for geonameid, (geom, path) in areas.items():
+        bbox = path.get_extents()
+        start = time.perf_counter()
+        exact = [bbox.contains(*coordinate) and path.contains_point(coordinate) for coordinate in coordinates]
+        t_path += time.perf_counter() - start
+
+        grid = grids[geonameid]
+        start = time.perf_counter()
+        fast = [grid.contains(coordinate) for coordinate in coordinates]
+        t_grid += time.perf_counter() - start
+
+        mismatches += sum(a != b for a, b in zip(exact, fast))
+
+    n_tests = n_points * len(areas)
+    n_exact = sum(grid.n_exact for grid in grids.values())
+    print(f"tests: {n_tests}, mismatches: {mismatches}, exact tests: {n_exact}")
+    print(f"path: {t_path:.2f}s grid: {t_grid:.2f}s speedup: {t_path / t_grid:.1f}x")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    n_points = int(args[0]) if args else 10000
+    cell_size = float(args[1]) if len(args) > 1 else AREA_GRID_CELL_SIZE
+    tolerance = float(args[2]) if len(args) > 2 else AREA_SIMPLIFICATION_TOLERANCE
+    benchmark(n_points, cell_size, tolerance)
@@ -0,0 +1,80 @@
+"""Benchmark of loading rows into PostgreSQL.
+
+Loads the same random geonames-like rows (with a point geometry) into an empty table,
+once with INSERT statements (PostgreSQL.commit_chunk, used before) and once with COPY
+(PostgreSQL.copy_rows), checks that both tables hold the same rows and reports the
+rows per second of each.
+
+    python -m benchmarks.copy_rows [n_rows]
+"""
+import sys
+import time
+import random
+
+from db.postgresql import PostgreSQL
+from geotag.config import POSTGRESQL_DB
+
+SRID = 4326
+
+
+def create_table(pg, table):
+    pg.cur.execute(f"DROP TABLE IF EXISTS {table}")
+    pg.cur.execute(f"""
+        CREATE TABLE {table} (
+        geonameid INT PRIMARY KEY,
+        name VARCHAR(200),
+        population BIGINT,
+        location GEOMETRY(Point, {SRID}))
+    """)
+    pg.conn.commit()
+
+
+def benchmark(n_rows=100000):
+    random.seed(0)
+    rows = [
+        (i, f"place\t{i}" if i % 10 == 0 else f"place {i}", float(random.randint(0, 10**6)), random.uniform(-180, 180), random.uniform(-90, 90))
+        for i in range(n_rows)
+    ]
+    pg = PostgreSQL(POSTGRESQL_DB)
+
+    create_table(pg, 'benchmark_insert')
+    start = time.time()
+    pg.commit_chunk(
+        "INSERT INTO benchmark_insert (geonameid, name, population, location) VALUES {}",
+        f"(%s, %s, %s, ST_GeomFromText('POINT(%s %s)', {SRID}))",
+        rows
+    )
+    t_insert = time.time() - start
+
+    create_table(pg, 'benchmark_copy')
+    start = time.time()
+    pg.copy_rows(
+        'benchmark_copy',
+        ['geonameid', 'name', 'population', 'longitude', 'latitude'],
+        rows,
+        points={'location': ('longitude', 'latitude')},
+        srid=SRID
+    )
+    t_copy = time.time() - start
+
+    pg.cur.execute("""
+        SELECT COUNT(*)
+        FROM benchmark_insert
+        FULL JOIN benchmark_copy USING (geonameid)
+        WHERE benchmark_insert.name IS DISTINCT FROM benchmark_copy.name
+            OR benchmark_insert.population IS DISTINCT FROM benchmark_copy.population
+            OR NOT ST_Equals(benchmark_insert.location, benchmark_copy.location)
+            OR benchmark_insert.location IS NULL OR benchmark_copy.location IS NULL
+    """)
+    mismatches, = pg.cur.fetchone()
+    for table in ('benchmark_insert', 'benchmark_copy'):
+        pg.cur.execute(f"DROP TABLE {table}")
+    pg.conn.commit()
+
+    print(f"rows: {n_rows}, mismatches: {mismatches}")
+    print(f"insert: {n_rows / t_insert:.0f} rows/s copy: {n_rows / t_copy:.0f} rows/s speedup: {t_insert / t_copy:.1f}x")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(int(args[0]) if args else 100000)
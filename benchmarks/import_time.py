@@ -0,0 +1,42 @@
+"""Benchmark of the time it takes to import a module, by default geotag.
+
+Imports the module in a fresh interpreter with -X importtime and reports the total
+import time and the modules that take longest to import (including their own imports).
+
+    python -m benchmarks.import_time [module] [n]
+"""
+import sys
+import subprocess
+
+
+def import_times(module):
+    """Returns the cumulative import time in seconds of each module imported by module"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if process.returncode != 0:
+        sys.exit(process.stderr.splitlines()[-1])
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def benchmark(module='geotag', n=15):
+    times = import_times(module)
+    print(f"import {module}: {times.get(module, 0):.2f}s ({len(times)} modules)")
+    # Only report top-level packages, their submodules are included in their times
+    packages = {name: t for name, t in times.items() if '.' not in name and name != module}
+    for name, t in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:n]:
+        print(f"{name:<30}{t:.3f}s")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    module = args[0] if args else 'geotag'
+    n = int(args[1]) if len(args) > 1 else 15
+    benchmark(module, n)
@@ -0,0 +1,81 @@
+"""Micro-benchmark of the text cleaning and tokenization of methods.sanitize.
+
+Compares the current functions (clean_text, tokenize, gramify) with the fast path
+(clean_text_fast, tokenize_fast, gramify_fast) on a recorded corpus of tweets and
+checks that both give the same ngrams. The corpus is a file with one tweet per line,
+either as a JSON object with a 'text' field (e.g. the _source of the tweets index)
+or as a JSON string.
+
+    python -m benchmarks.sanitize tweets.jsonl
+"""
+import sys
+import json
+import time
+
+from methods import sanitize
+
+
+def load_corpus(file_path):
+    texts = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            tweet = json.loads(line)
+            texts.append(tweet['text'] if isinstance(tweet, dict) else tweet)
+    return texts
+
+
+def ngrams_current(text):
+    clean_text = sanitize.clean_text(text, lower=False)
+    tokens = sanitize.tokenize(clean_text, remove_punctuation=True)
+    return clean_text, set(sanitize.discard_ngrams_with_digits(sanitize.gramify(tokens, 1, 3)))
+
+
+def ngrams_fast(text):
+    clean_text = sanitize.clean_text_fast(text, lower=False)
+    tokens = sanitize.tokenize_fast(clean_text, remove_punctuation=True)
+    return clean_text, set(sanitize.gramify_fast(tokens, 1, 3, discard_digits=True))
+
+
+def timeit(function, texts, repeat=3):
+    """Return the best time of repeat runs over all texts"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            function(text)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def compare(texts):
+    mismatches = [text for text in texts if ngrams_current(text) != ngrams_fast(text)]
+    simple = sum(sanitize.is_simple_text(sanitize.clean_text_fast(text, lower=False)) for text in texts)
+    print(f"tweets: {len(texts)}, simple texts: {simple / len(texts):.1%}, mismatches: {len(mismatches)}")
+    for text in mismatches[:10]:
+        print(f"\t{text!r}")
+
+    stages = [
+        ('clean_text', sanitize.clean_text, sanitize.clean_text_fast),
+        ('tokenize', lambda text: sanitize.tokenize(text, remove_punctuation=True), lambda text: sanitize.tokenize_fast(text, remove_punctuation=True)),
+        ('ngrams (all stages)', ngrams_current, ngrams_fast),
+    ]
+    for name, current, fast in stages:
+        if name == 'tokenize':
+            inputs = [sanitize.clean_text(text, lower=False) for text in texts]
+        else:
+            inputs = texts
+        t_current = timeit(current, inputs)
+        t_fast = timeit(fast, inputs)
+        print(f"{name:<20} current: {t_current:.3f}s fast: {t_fast:.3f}s speedup: {t_current / t_fast:.1f}x")
+    return mismatches
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    compare(load_corpus(sys.argv[1]))
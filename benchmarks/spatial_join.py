@@ -0,0 +1,44 @@
+"""Benchmark of matching the geonames with their time zone.
+
+Joins the geonames with the time_zones table in PostGIS (ST_Within, as the UPDATE of
+Preprocess.find_time_zones) and in Python (methods.geo.spatial_join), checks that both
+give the same time zones and reports the run time of each.
+
+    python -m benchmarks.spatial_join [n_processes] [tile_size]
+"""
+import sys
+import time
+
+from methods import geo
+from geotag.config import pg
+
+
+def benchmark(n_processes=4, tile_size=1):
+    start = time.perf_counter()
+    pg.cur.execute("""
+        SELECT geonames.geonameid, time_zones.name
+        FROM geonames
+        JOIN time_zones ON ST_Within(geonames.location, time_zones.geom)
+    """)
+    postgis = dict(pg.cur.fetchall())
+    t_postgis = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pg.cur.execute("SELECT geonameid, ST_X(location), ST_Y(location) FROM geonames WHERE location IS NOT NULL")
+    points = pg.cur.fetchall()
+    pg.cur.execute("SELECT name, ST_AsBinary(geom) FROM time_zones WHERE geom IS NOT NULL")
+    areas = [(name, bytes(wkb)) for name, wkb in pg.cur.fetchall()]
+    python = geo.spatial_join(points, areas, n_processes, tile_size)
+    t_python = time.perf_counter() - start
+
+    # Points within overlapping time zones can be matched with either
+    mismatches = sum(postgis.get(geonameid) != python.get(geonameid) for geonameid in set(postgis) | set(python))
+    print(f"points: {len(points)}, matched: {len(python)}, mismatches: {mismatches}")
+    print(f"postgis: {t_postgis:.1f}s python: {t_python:.1f}s speedup: {t_postgis / t_python:.1f}x")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    n_processes = int(args[0]) if args else 4
+    tile_size = float(args[1]) if len(args) > 1 else 1
+    benchmark(n_processes, tile_size)
@@ -0,0 +1,122 @@
+"""Benchmark of the startup loaders of Base that query PostgreSQL.
+
+Runs the previous loaders, which made two queries for every country and adm1, next
+to the current set-based loaders, checks that both return the same and reports the
+run time of each. Finally reports the run time of all loaders of a full Base.
+
+    python -m benchmarks.startup [n_words]
+"""
+import sys
+import time
+
+from geotag.analyze import Base, load_most_common_words
+from geotag.config import pg
+
+
+def alternative_names_per_geonameid(geonameids, location_type):
+    """The loader used before: two queries for each geonameid"""
+    names = {}
+    for geonameid in geonameids:
+        pg.cur.execute(f"""SELECT name, full_name, population, country_geonameid, adm1_geonameid FROM geonames WHERE geonameid = {geonameid}""")
+        res = pg.cur.fetchone()
+        if res is None:
+            continue
+        name, full_name, population, country_geonameid, adm1_geonameid = res
+        geonameid_info = {
+            'type': location_type,
+            'abbreviations': [],
+            "toponym": name,
+            "geonameid": geonameid,
+            "population": population,
+            "country_geonameid": country_geonameid,
+            "adm1_geonameid": adm1_geonameid
+        }
+        names.setdefault(name, {})[geonameid] = geonameid_info
+
+        pg.cur.execute(f"""SELECT alternate_name, isolanguage, full_name FROM alternate_names WHERE geonameid = {geonameid}""")
+        for name, isolanguage, full_name in pg.cur.fetchall():
+            names.setdefault(name, {}).setdefault(geonameid, geonameid_info)
+            if isolanguage == 'abbr':
+                names[name][geonameid]['abbreviations'].append(full_name)
+    return names
+
+
+def most_common_words_per_language(n):
+    """The loader used before: one query for each language"""
+    pg.cur.execute("""SELECT name FROM geonames WHERE population > 100000""")
+    places_high_population = set(name for name, in pg.cur.fetchall())
+    d = {}
+    pg.cur.execute("""SELECT DISTINCT language FROM most_common_words""")
+    for language, in pg.cur.fetchall():
+        d[language] = set()
+        pg.cur.execute(f"""SELECT word FROM most_common_words WHERE language = '{language}' ORDER BY n ASC LIMIT {n}""")
+        for word, in pg.cur.fetchall():
+            word = word.lower()
+            if word not in places_high_population:
+                d[language].add(word)
+    return d
+
+
+def most_common_words_languages():
+    pg.cur.execute("""SELECT DISTINCT language FROM most_common_words""")
+    return [language for language, in pg.cur.fetchall()]
+
+
+def normalize(names):
+    """Names with sorted abbreviations, which are returned in no particular order"""
+    return {
+        name: {geonameid: dict(info, abbreviations=sorted(info['abbreviations'])) for geonameid, info in locations.items()}
+        for name, locations in names.items()
+    }
+
+
+def compare(name, before, after):
+    start = time.perf_counter()
+    before_result = before()
+    t_before = time.perf_counter() - start
+    start = time.perf_counter()
+    after_result = after()
+    t_after = time.perf_counter() - start
+    print(f"{name}: before {t_before:.2f}s after {t_after:.2f}s equal: {before_result == after_result}")
+
+
+def benchmark(n_words=1000):
+    base = Base.__new__(Base)
+    base.startup_times = {}
+
+    pg.cur.execute("SELECT geonameid FROM countries")
+    countries = [geonameid for geonameid, in pg.cur.fetchall()]
+    compare(
+        'alternative names countries',
+        lambda: normalize(alternative_names_per_geonameid(countries, 'country')),
+        lambda: normalize(base._get_alternative_names_countries())
+    )
+
+    pg.cur.execute("""
+        SELECT geonameid
+        FROM geonames
+        WHERE feature_code IN ('ADM1', 'ADM1H', 'ADM2', 'ADM2H')
+            OR geonames.geonameid IN (
+                SELECT adm1.geonameid FROM adm1
+            )
+    """)
+    adm1 = [geonameid for geonameid, in pg.cur.fetchall()]
+    compare(
+        'alternative names adm1',
+        lambda: normalize(alternative_names_per_geonameid(adm1, 'adm1')),
+        lambda: normalize(base._get_alternative_names_adm1())
+    )
+
+    compare(
+        'most common words',
+        lambda: most_common_words_per_language(n_words),
+        lambda: {language: load_most_common_words(language, n_words) for language in most_common_words_languages()}
+    )
+
+    print()
+    Base(n_words)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(int(args[0]) if args else 1000)
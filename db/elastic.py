@@ -28,6 +28,12 @@ class Elastic(Elasticsearch):
                 except StopIteration:
                     break
 
+    def parallel_bulk_operation(self, iterator, size=1000, n_threads=4):
+        """Like bulk_operation, but sends n_threads chunks to Elasticsearch at once"""
+        if iterator:
+            for _ in helpers.parallel_bulk(self, iterator, thread_count=n_threads, chunk_size=size, request_timeout=60):
+                pass
+
     def loop_search(self, page, source=True):
         for hit in page['hits']['hits']:
             if source:
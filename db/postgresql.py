@@ -1,3 +1,6 @@
+import io
+import time
+import itertools
 import numpy as np
 import psycopg2
 from psycopg2.extensions import register_adapter, AsIs
@@ -13,6 +16,9 @@ from config import (
 
 
 class PostgreSQL:
+    # Numbers for the names of server-side cursors
+    _cursor_ids = itertools.count()
+
     def __init__(self, db):
         self.conn, self.cur = self._connect(POSTGRESQL_HOST, POSTGRESQL_PORT, POSTGRESQL_USER, POSTGRESQL_PASSWORD, db)
 
@@ -28,6 +34,77 @@ class PostgreSQL:
         if commit:
             self.conn.commit()
 
+    def copy_rows(self, table, columns, rows, points=None, srid=4326, size=100000, commit=True):
+        """Loads rows (a DataFrame or an iterable of tuples) into the columns of table with
+        COPY FROM STDIN, in chunks of size rows, and prints the number of rows loaded per second.
+        points maps the point geometry columns of table to the pair of columns holding their
+        x and y coordinates. The rows are then first loaded into a temporary table, from which
+        the points are created with a single INSERT ... SELECT. The rows are committed unless
+        commit is False"""
+        if hasattr(rows, 'itertuples'):
+            rows = rows[columns].itertuples(index=False, name=None)
+        rows = iter(rows)
+
+        if points:
+            coordinates = [column for xy in points.values() for column in xy]
+            target = f'copy_{table}'
+            self.cur.execute(f"DROP TABLE IF EXISTS {target}")
+            self.cur.execute(f"CREATE TEMPORARY TABLE {target} (LIKE {table})")
+            for column in coordinates:
+                self.cur.execute(f"ALTER TABLE {target} ADD COLUMN {column} DOUBLE PRECISION")
+        else:
+            target = table
+
+        start = time.time()
+        n_rows = 0
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                break
+            f = io.StringIO()
+            f.writelines('\t'.join(self._copy_value(value) for value in row) + '\n' for row in chunk)
+            f.seek(0)
+            self.cur.copy_expert(f"COPY {target} ({', '.join(columns)}) FROM STDIN", f)
+            n_rows += len(chunk)
+            print(f"Loading {table}: {n_rows} rows ({round(n_rows / max(time.time() - start, 1e-6))} rows/s)", end="\r")
+
+        if points:
+            other_columns = [column for column in columns if column not in coordinates]
+            self.cur.execute(f"""
+                INSERT INTO {table} ({', '.join(other_columns + list(points))})
+                SELECT {', '.join(other_columns + [f'ST_SetSRID(ST_MakePoint({x}, {y}), {srid})' for x, y in points.values()])}
+                FROM {target}
+            """)
+            self.cur.execute(f"DROP TABLE {target}")
+        if commit:
+            self.conn.commit()
+        print(f"Loading {table}: {n_rows} rows ({round(n_rows / max(time.time() - start, 1e-6))} rows/s)")
+
+    @staticmethod
+    def _copy_value(value):
+        """Returns value in the text format of COPY"""
+        if value is None:
+            return '\\N'
+        if isinstance(value, (bool, np.bool_)):
+            return 't' if value else 'f'
+        if isinstance(value, (float, np.floating)):
+            if np.isnan(value):
+                return '\\N'
+            # Whole numbers are also loaded into integer columns, as with INSERT
+            if float(value).is_integer():
+                return str(int(value))
+            return repr(float(value))
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def stream(self, query, args=None, size=10000):
+        """Generator that yields the rows of a query. The rows are fetched in
+        batches of size through a server-side cursor"""
+        with self.conn.cursor(name=f'stream_{next(self._cursor_ids)}') as cur:
+            cur.itersize = size
+            cur.execute(query, args)
+            for row in cur:
+                yield row
+
     def _connect(self, host, port, user, password, db):
         try:
             if password:
@@ -1,12 +1,14 @@
 import datetime
 import sys
-import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from operator import itemgetter
 
 from geotag.analyze import TweetAnalyzer
-from methods import clean
+from methods import clean, function
 
 from geotag.config import (
+    TWEETS_INDEX,
     TOPONYM_RESOLUTION_TABLE,
     SCORE_TYPES,
     GeotagCustom,
@@ -27,6 +29,18 @@ class Geotag(GeotagCustom):
         self.tweet_analyzer = TweetAnalyzer(min_population_capitalized, min_population_non_capitalized, n_words)
         self.threshold = threshold
         self.analysis_length = analysis_length
+        # Kept so that the same Geotag can be rebuilt in other processes (see history_sharded)
+        self.parameters = {
+            'threshold': threshold,
+            'min_population_capitalized': min_population_capitalized,
+            'min_population_non_capitalized': min_population_non_capitalized,
+            'n_words': n_words,
+            'analysis_length': analysis_length
+        }
+        # Start of the shard when running as part of a sharded backfill. Updates for tweets
+        # older than the shard start are held back in the spillover to be stitched afterwards.
+        self.shard_start = None
+        self.spillover = {}
 
         GeotagCustom.__init__(self)
 
@@ -52,6 +66,7 @@ class Geotag(GeotagCustom):
         compared, then if the number of tweets is still greater than one, the
         consine similarity is used to eliminate tweets lower than a cosine
         similarity of {default}"""
+        import pandas as pd
         df = [(tweet['id'], tweet['text'], tweet['date']) for tweet in tweets]
         df = pd.DataFrame(tweets, columns=['id', 'text', 'date']).set_index('id')
         idx = df.groupby(['text'])['date'].transform(min) == df['date']
@@ -63,6 +78,20 @@ class Geotag(GeotagCustom):
         ids = set(df.index)
         return [tweet for tweet in tweets if tweet['id'] in ids]
 
+    def commit(self, tweets):
+        """Commit tweets to the database. If running as a shard, updates of tweets
+        that belong to the previous shard are held back in the spillover"""
+        if self.shard_start:
+            tweets = self._hold_back_spillover(tweets)
+        GeotagCustom.commit(self, tweets)
+
+    def _hold_back_spillover(self, tweets):
+        for body in tweets:
+            if self.tweets[body['_id']]['date'] < self.shard_start:
+                self.spillover[body['_id']] = body['doc']['locations']
+            else:
+                yield body
+
     def delete_data(self, timestep_start):
         """Delete all data older than the start of the start of the timestep"""
         to_delete = set()
@@ -92,121 +121,142 @@ class Geotag(GeotagCustom):
                 docs_one_per_user.append(docs[0])
         return docs_one_per_user
 
-    def resolve_toponyms(self, toponyms, timestep_end):
-        """This function resolves the toponyms to a location and yields for each
-        toponym the tweet ids and the resolved toponym"""
-        for toponym, geonameids in toponyms.items():
-
-            toponym_scores = []
-            # Loop through all potential toponyms
-            for geonameid, info in geonameids.items():
-                tweets = info['tweets']
-
-                geonameid_scores = {
-                    'tweet_ids': [tweet['id'] for tweet in tweets],
-                    'geonameid': geonameid,
-                    'type': info['type'],
-                    'population': info['population'],
-                    'country_geonameid': info['country_geonameid'],
-                    'adm1_geonameid': info['adm1_geonameid'],
-                    'coordinates': info['coordinates'],
-                    'language': info['language'],
-                    'abbreviations': info['abbreviations']
-                }
-
-                geonameid_avg_score = 0
-                one_tweet_per_user = self.get_one_per_user(tweets)
-                # Calculate for each score type the score
-                for score_type in SCORE_TYPES.keys():
-                    if score_type == 'family':
-                        # Only if one of the scores for family is non-zero we need to compute the scores without duplicates.
-                        # This is useful, because this operation takes especially long
-                        if sum(tweet['scores']['family'] for tweet in tweets) > 0:
-                            # Eliminate all duplicates. If non is given: cosine-similarity > 0.8
-                            # Only consider the ones that have a family member anyway
-                            tweets_w_family = [tweet for tweet in tweets if tweet['scores']['family'] is True]
-                            if len(tweets_w_family) > 1:
-                                tweets_wo_duplicates = self.eliminate_duplicates(tweets)
-                            else:
-                                tweets_wo_duplicates = tweets_w_family
-                            if tweets_wo_duplicates:
-                                # Convert numpy.int to int
-                                geonameid_type_score = int(sum(
-                                    tweet['scores']['family'] for tweet in tweets_wo_duplicates
-                                    if ('general' in info['language'] or tweet['language'] in info['language'])
-                                ))
-                                geonameid_avg_type_score = geonameid_type_score / len(tweets_wo_duplicates)
-                        else:
-                            geonameid_type_score = 0
-                            geonameid_avg_type_score = 0
-
+    def sum_type_scores(self, info):
+        """Returns for each score type the summed score of the tweets of a potential location
+        and the number of tweets the score is averaged over"""
+        tweets = info['tweets']
+        one_tweet_per_user = self.get_one_per_user(tweets)
+        type_scores = {}
+        for score_type in SCORE_TYPES.keys():
+            if score_type == 'family':
+                # Only if one of the scores for family is non-zero we need to compute the scores without duplicates.
+                # This is useful, because this operation takes especially long
+                tweets_wo_duplicates = None
+                if sum(tweet['scores']['family'] for tweet in tweets) > 0:
+                    # Eliminate all duplicates. If non is given: cosine-similarity > 0.8
+                    # Only consider the ones that have a family member anyway
+                    tweets_w_family = [tweet for tweet in tweets if tweet['scores']['family'] > 0]
+                    if len(tweets_w_family) > 1:
+                        tweets_wo_duplicates = self.eliminate_duplicates(tweets)
                     else:
-                        # For all other types only consider one tweet per user
-                        # Convert numpy.int to int
-                        geonameid_type_score = int(sum(
-                            tweet['scores'][score_type] for tweet in one_tweet_per_user
+                        tweets_wo_duplicates = tweets_w_family
+                if tweets_wo_duplicates:
+                    type_scores[score_type] = (
+                        sum(
+                            tweet['scores']['family'] for tweet in tweets_wo_duplicates
                             if ('general' in info['language'] or tweet['language'] in info['language'])
-                        ))
-                        geonameid_avg_type_score = geonameid_type_score / len(one_tweet_per_user)
-
-                    geonameid_scores[score_type] = {'type_score': geonameid_type_score, 'avg_type_score': geonameid_avg_type_score}
-                    geonameid_avg_score += geonameid_avg_type_score
-
-                geonameid_scores.update({
-                    'avg_score': round(geonameid_avg_score, 3)
-                })
-
-                toponym_scores.append(geonameid_scores)
-
-            # Once all scores for the topnym are collected, filter by minimum score, unless the type is country or continent
-            toponym_scores = [score for score in toponym_scores if score['avg_score'] >= self.threshold or score['type'] in ['country', 'continent']]
-            if toponym_scores:
-                toponym_scores = sorted(
-                    sorted(
-                        toponym_scores,
-                        key=itemgetter('population'),
-                        reverse=True
+                        ),
+                        len(tweets_wo_duplicates)
+                    )
+                else:
+                    type_scores[score_type] = (0, 1)
+            else:
+                # For all other types only consider one tweet per user
+                type_scores[score_type] = (
+                    sum(
+                        tweet['scores'][score_type] for tweet in one_tweet_per_user
+                        if ('general' in info['language'] or tweet['language'] in info['language'])
                     ),
-                    key=itemgetter('avg_score'),
-                    reverse=True
+                    len(one_tweet_per_user)
                 )
-                # Pick the location with the highest score as the resolved location
-                resolved_location = toponym_scores[0]
-                # If all locations have a score of 0, take the one with the highest population
-                # nuber.
-                if resolved_location['avg_score'] == 0:
-                    resolved_location = max(toponym_scores, key=itemgetter('population'))
-
-                def find_similar_in_country(resolved_location, toponym_scores):
-                    if resolved_location['type'] == 'adm1':
-                        return resolved_location
-                    else:
-                        for toponym_score in toponym_scores:
-                            if (
-                                toponym_score['type'] == 'adm1' and toponym_score['country_geonameid'] == resolved_location['country_geonameid']
-                            ):
-                                return toponym_score
-                        else:
-                            return resolved_location
-
-                if any(score['type'] in ['country', 'continent'] for score in toponym_scores):
-                    resolved_location = sorted([score for score in toponym_scores if score['type'] in ['country', 'continent']], key=itemgetter('population'), reverse=True)[0]
+        return type_scores
+
+    def score_location(self, geonameid, info, type_scores):
+        """Returns the scores of a potential location of a toponym from the summed type scores"""
+        geonameid_scores = {
+            'tweet_ids': [tweet['id'] for tweet in info['tweets']],
+            'geonameid': geonameid,
+            'type': info['type'],
+            'population': info['population'],
+            'country_geonameid': info['country_geonameid'],
+            'adm1_geonameid': info['adm1_geonameid'],
+            'coordinates': info['coordinates'],
+            'language': info['language'],
+            'abbreviations': info['abbreviations']
+        }
+
+        geonameid_avg_score = 0
+        for score_type, (type_score, n) in type_scores.items():
+            # Convert numpy.int to int
+            geonameid_type_score = int(type_score)
+            geonameid_avg_type_score = geonameid_type_score / n
+            geonameid_scores[score_type] = {'type_score': geonameid_type_score, 'avg_type_score': geonameid_avg_type_score}
+            geonameid_avg_score += geonameid_avg_type_score
+
+        geonameid_scores.update({
+            'avg_score': round(geonameid_avg_score, 3)
+        })
+        return geonameid_scores
+
+    def select_location(self, toponym, toponym_scores, threshold):
+        """Picks the resolved location from the scores of all potential locations of a toponym.
+        Returns the ids of the tweets and the resolved location or None if no location is resolved"""
+        # Once all scores for the topnym are collected, filter by minimum score, unless the type is country or continent
+        toponym_scores = [score for score in toponym_scores if score['avg_score'] >= threshold or score['type'] in ['country', 'continent']]
+        if not toponym_scores:
+            return None
+        toponym_scores = sorted(
+            sorted(
+                toponym_scores,
+                key=itemgetter('population'),
+                reverse=True
+            ),
+            key=itemgetter('avg_score'),
+            reverse=True
+        )
+        # Pick the location with the highest score as the resolved location
+        resolved_location = toponym_scores[0]
+        # If all locations have a score of 0, take the one with the highest population
+        # nuber.
+        if resolved_location['avg_score'] == 0:
+            resolved_location = max(toponym_scores, key=itemgetter('population'))
+
+        def find_similar_in_country(resolved_location, toponym_scores):
+            if resolved_location['type'] == 'adm1':
+                return resolved_location
+            else:
+                for toponym_score in toponym_scores:
+                    if (
+                        toponym_score['type'] == 'adm1' and toponym_score['country_geonameid'] == resolved_location['country_geonameid']
+                    ):
+                        return toponym_score
                 else:
-                    resolved_location = find_similar_in_country(resolved_location, toponym_scores)
-
-                resolved_location['toponym'] = toponym
-
-                # If the language of the tweet matches tha language of the resolved toponym, yield those ids
-                ids = [
-                    tweet_id for tweet_id in resolved_location['tweet_ids']
-                    if ('general' in resolved_location['language'] or
-                        (
-                            'abbr' in resolved_location['language'] and
-                            self.tweets[tweet_id]['original_ngrams'][toponym] in resolved_location['abbreviations']
-                        ) or
-                        self.tweets[tweet_id]['language'] in resolved_location['language'])
-                ]
-                del resolved_location['tweet_ids']
+                    return resolved_location
+
+        if any(score['type'] in ['country', 'continent'] for score in toponym_scores):
+            resolved_location = sorted([score for score in toponym_scores if score['type'] in ['country', 'continent']], key=itemgetter('population'), reverse=True)[0]
+        else:
+            resolved_location = find_similar_in_country(resolved_location, toponym_scores)
+
+        # Copy, so that the scores can be reused for another threshold
+        resolved_location = dict(resolved_location)
+        resolved_location['toponym'] = toponym
+
+        # If the language of the tweet matches tha language of the resolved toponym, yield those ids
+        ids = [
+            tweet_id for tweet_id in resolved_location['tweet_ids']
+            if ('general' in resolved_location['language'] or
+                (
+                    'abbr' in resolved_location['language'] and
+                    self.tweets[tweet_id]['original_ngrams'][toponym] in resolved_location['abbreviations']
+                ) or
+                self.tweets[tweet_id]['language'] in resolved_location['language'])
+        ]
+        del resolved_location['tweet_ids']
+        return ids, resolved_location
+
+    def resolve_toponyms(self, toponyms, timestep_end):
+        """This function resolves the toponyms to a location and yields for each
+        toponym the tweet ids and the resolved toponym"""
+        for toponym, geonameids in toponyms.items():
+            # Loop through all potential toponyms
+            toponym_scores = [
+                self.score_location(geonameid, info, self.sum_type_scores(info))
+                for geonameid, info in geonameids.items()
+            ]
+            resolved = self.select_location(toponym, toponym_scores, self.threshold)
+            if resolved:
+                ids, resolved_location = resolved
                 yield toponym, ids, resolved_location
 
     def tweets_to_toponyms(self):
@@ -269,6 +319,14 @@ class Geotag(GeotagCustom):
         # Get the toponym dict (toponym as key and tweets and locations as values)
         toponyms = self.tweets_to_toponyms()
 
+        fully_resolved = self.assign_locations(self.resolve_toponyms(toponyms, timestep_end))
+
+        # And finally commit everything to the database
+        self.commit(self.locations_to_commit(fully_resolved))
+
+    def assign_locations(self, resolved):
+        """Takes the resolved toponyms (toponym, tweet ids and location) and returns a dictionary
+        with the locations of each tweet"""
         # If a tweet has multiple locations, we perfom some extra checks. So defince a set
         # which will be used to store tweet ids with multiple locations. And a seen_ids to keep
         # track of the ids we already have. (i.e. if a tweet is already in the seen_id, it is added
@@ -277,7 +335,7 @@ class Geotag(GeotagCustom):
         # Loop through the resolved toponyms and use the seend logic (its a generator). Tweet are added
         # to the resolved toponyms. However, not yet to the fully resolved toponyms, because we still want
         # to take an extra look at the duplicates
-        for toponym, ids, location in self.resolve_toponyms(toponyms, timestep_end):
+        for toponym, ids, location in resolved:
             location.update({'toponym': toponym})
             for tweet_id in ids:
                 if tweet_id in resolved_locations:
@@ -305,9 +363,7 @@ class Geotag(GeotagCustom):
 
             if locations:
                 fully_resolved[tweet_id] = locations
-
-        # And finally commit everything to the database
-        self.commit(self.locations_to_commit(fully_resolved))
+        return fully_resolved
 
     def history(self, start, timestep_length, end=False, realtime=False):
         """This function is the driver behind the whole historic part of the script. It
@@ -318,6 +374,15 @@ class Geotag(GeotagCustom):
         print("building spinup")
         self.build_spinup(spinup_start, start)
 
+        timestep_end = self._run_timesteps(start, timestep_length, end)
+
+        if realtime and not end:
+            last_timestep_end = timestep_end - timestep_length
+            self.realtime(last_timestep_end)
+
+    def _run_timesteps(self, start, timestep_length, end):
+        """Analyze all timesteps after start until end (or now). Returns the end of the
+        first timestep that was not analyzed"""
         timestep = 1
         timestep_end = start + timestep * timestep_length
 
@@ -329,10 +394,71 @@ class Geotag(GeotagCustom):
 
             timestep += 1
             timestep_end = start + timestep * timestep_length
-
-        if realtime and not end:
-            last_timestep_end = timestep_end - timestep_length
-            self.realtime(last_timestep_end)
+        return timestep_end
+
+    def split_shards(self, start, end, timestep_length, n_shards):
+        """Split the timesteps between start and end in (at most) n_shards consecutive
+        shards. Shard boundaries are aligned with the timesteps of a sequential run"""
+        n_timesteps = 0
+        while start + (n_timesteps + 1) * timestep_length <= end:
+            n_timesteps += 1
+        n_shards = max(min(n_shards, n_timesteps), 1)
+        shards = []
+        for i in range(n_shards):
+            first = i * n_timesteps // n_shards
+            last = (i + 1) * n_timesteps // n_shards
+            shards.append((start + first * timestep_length, start + last * timestep_length))
+        return shards
+
+    def history_sharded(self, start, timestep_length, end=False, n_shards=4, n_processes=None):
+        """Historic geotagging split in time shards that are analyzed in separate processes. Each
+        shard builds its own spinup of analysis_length before the start of the shard, so that the
+        resolution of each timestep is identical to a sequential run with history. Updates of
+        tweets that are part of the spinup of a shard (and thus belong to the previous shard) are
+        returned by the shards and merged with the locations already committed afterwards"""
+        if not end:
+            end = datetime.datetime.utcnow()
+        shards = self.split_shards(start, end, timestep_length, n_shards)
+        print(f"running {len(shards)} shards")
+
+        executor = ProcessPoolExecutor(
+            max_workers=n_processes or len(shards),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        with executor:
+            futures = [
+                executor.submit(
+                    _history_shard,
+                    self.parameters,
+                    shard_start,
+                    shard_end,
+                    timestep_length,
+                    hold_back=i > 0
+                )
+                for i, (shard_start, shard_end) in enumerate(shards)
+            ]
+            spillovers = [future.result() for future in futures]
+
+        print("stitching shards")
+        self.tweets = {}
+        for spillover in spillovers:
+            self.stitch_spillover(spillover)
+
+    def stitch_spillover(self, spillover):
+        """Merge the locations held back by a shard with the locations that are committed
+        for these tweets by the previous shard"""
+        IDs = [ID for ID in spillover if ID not in self.tweets]
+        for chunk in function.chunker(IDs, 1000):
+            documents = es_tweets.mget(
+                index=TWEETS_INDEX,
+                doc_type='tweet',
+                body={'ids': chunk}
+            )['docs']
+            for doc in documents:
+                self.tweets[doc['_id']] = {}
+                if doc['found'] and 'locations' in doc['_source']:
+                    self.tweets[doc['_id']]['locations'] = doc['_source']['locations']
+        self.commit(self.locations_to_commit(spillover))
 
     def realtime(self, last_timestep_end=False):
         """This is the realtime geotagger"""
@@ -345,3 +471,13 @@ class Geotag(GeotagCustom):
 
             self.analyze_timestep(timestep_end - self.analysis_length, timestep_end, last_timestep_end, realtime=True)
             last_timestep_end = timestep_end
+
+
+def _history_shard(parameters, shard_start, shard_end, timestep_length, hold_back=True):
+    """Run one shard of history_sharded. Runs in a separate process and returns the
+    locations of tweets from before the shard start"""
+    geotagger = Geotag(**parameters)
+    if hold_back:
+        geotagger.shard_start = shard_start
+    geotagger.history(shard_start, timestep_length, end=shard_end)
+    return geotagger.spillover
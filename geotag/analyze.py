@@ -1,14 +1,21 @@
-from pytz import all_timezones, timezone
-from re import compile
+import os
+import json
+import time
+import pickle
+import hashlib
+from functools import wraps, lru_cache
+from pytz import all_timezones, all_timezones_set, timezone, utc
+from pytz import __version__ as pytz_version
+from re import compile, escape
 import elasticsearch.exceptions
-from itertools import combinations
-from datetime import timedelta, datetime
+from bisect import bisect_right
+from datetime import datetime
 from operator import itemgetter
 from collections import defaultdict as dd
 from collections import OrderedDict
-import pandas as pd
 
-from methods import sanitize, spatial, geo
+from methods import sanitize, spatial, geo, dates, function
+from geotag import relations
 
 from geotag.config import (
     TWEETS_INDEX,
@@ -18,7 +25,17 @@ from geotag.config import (
     NEAR_DISTANCE,
     MAX_DISTANCE_CITY_COORDINATE,
     MAX_DISTANCE_BBOX_CENTER,
+    AREA_GRID_CELL_SIZE,
+    AREA_SIMPLIFICATION_TOLERANCE,
+    TIME_ZONE_TABLE_YEARS,
+    TIME_ZONE_TABLE_FILE,
     SCORE_TYPES,
+    TEXT_CACHE_SIZE,
+    USER_LOCATIONS_FILE,
+    LANGUAGES,
+    ANALYZER_STATE_FILE,
+    ANALYZER_STATE_INPUT_FILES,
+    ANALYZER_STATE_INPUT_STEPS,
     TweetAnalyzerCustom,
     es_tweets,
     es_toponyms,
@@ -28,10 +45,67 @@ from geotag.config import (
 first_word_recognizer = compile('(?:^|(?:[.!?:]\s))(\w+)')
 
 
+# Version of the analyzer state. Increase when the state built by Base changes
+ANALYZER_STATE_VERSION = 2
+
+
+def timed(load):
+    """Decorator that records the run time of a loader of Base in startup_times"""
+    @wraps(load)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = load(self, *args, **kwargs)
+        self.startup_times[load.__name__] = time.perf_counter() - start
+        return result
+    return wrapper
+
+
+def load_exact_geom(table, geonameid):
+    """Return the exact geometry of a country or continent"""
+    pg.cur.execute(f"SELECT ST_AsText(geom) FROM {table} WHERE geonameid = %s", (geonameid, ))
+    return geo.wkt_to_geom(pg.cur.fetchone()[0])
+
+
+class PerLanguage(dict):
+    """Dictionary with a resource for each language. The resource of a language is
+    only loaded (with load(language, *args)) when it is first used"""
+    def __init__(self, load, *args):
+        dict.__init__(self)
+        self.load = load
+        self.args = args
+
+    def __missing__(self, language):
+        resource = self.load(language, *self.args)
+        self[language] = resource
+        return resource
+
+
+def load_tag_stripper(language, tags):
+    return TagStripper(tags[language])
+
+
+@lru_cache(maxsize=None)
+def load_places_high_population():
+    """Return the set of names of places with a population over 100000"""
+    return frozenset(name for name, in pg.stream("""SELECT name FROM geonames WHERE population > 100000"""))
+
+
+def load_most_common_words(language, n):
+    """Return the n (max = 10000) most common words of a language, except names of
+    places with a high population"""
+    places_high_population = load_places_high_population()
+    words = set()
+    for word, in pg.stream("""SELECT word FROM most_common_words WHERE language = %s AND n <= %s""", (language, n)):
+        word = word.lower()
+        if word not in places_high_population:
+            words.add(word)
+    return words
+
+
 class LastUserLocationDict(OrderedDict):
+    """Dictionary that holds the size most recently used items"""
     def __init__(self, size, *args, **kwargs):
-        self.size = 10000
-        self.pop = False
+        self.size = size
         OrderedDict.__init__(self, *args, **kwargs)
 
     def getandmove(self, key):
@@ -40,99 +114,253 @@ class LastUserLocationDict(OrderedDict):
 
     def __setitem__(self, key, value):
         OrderedDict.__setitem__(self, key, value)
-        if not self.pop and len(self) > self.size:
-            self.pop = True
-        if self.pop:
+        self.move_to_end(key)
+        while len(self) > self.size:
             self.popitem(last=False)
 
 
-class Offset2TimeZones(dict):
-    def __missing__(self, key):
-        self[key] = []
+class ToponymRequests(set):
+    """Collects the names that are looked up in the toponym index (see
+    TweetAnalyzer.get_toponym_locations), without looking them up"""
+    def get(self, name):
+        self.add(name)
+        return None
 
-    def find_timezones(self, offset, dt, timezone=timezone, all_timezones_set=set(all_timezones)):
-        maximum_date = dt + timedelta(days=365)
-        td = timedelta(days=3)
-        tzs = {
-            tz.zone for tz in map(timezone, all_timezones_set)
-            if dt.astimezone(tz).utcoffset() == offset
-        }
 
-        while True:
-            dt += td
+class TimeZoneBits(dict):
+    """Interns time zone names to bits, so that a set of time zones can be represented
+    by an integer bitmask and intersected with a bitwise and"""
+    def __init__(self, names=()):
+        dict.__init__(self)
+        for name in names:
+            self[name]
+
+    def __missing__(self, name):
+        bit = 1 << len(self)
+        self[name] = bit
+        return bit
+
+    def mask(self, names):
+        """Returns the bitmask of the names. Names without a bit are not time zones
+        and are left out"""
+        mask = 0
+        for name in names:
+            mask |= self.get(name, 0)
+        return mask
+
+
+class Offset2TimeZones:
+    """Finds the time zones that have a given UTC offset at a given (UTC) time. For the
+    years in TIME_ZONE_TABLE_YEARS the offsets of all time zones are precomputed in a
+    table with, for each offset, the start times of the intervals in which the set of
+    time zones with that offset is constant. The sets are stored as bitmasks of
+    zone_bits. The table is built once, saved to TIME_ZONE_TABLE_FILE and loaded on
+    first use"""
+    def __init__(self, years=TIME_ZONE_TABLE_YEARS, file_path=TIME_ZONE_TABLE_FILE):
+        self.years = years
+        self.file_path = file_path
+        self.start = datetime(years[0], 1, 1)
+        self.end = datetime(years[1] + 1, 1, 1)
+        self.zone_bits = TimeZoneBits(sorted(all_timezones))
+        self.table = None
+
+    def utc_offset(self, tz, dt):
+        """Returns the UTC offset in seconds of a time zone at a UTC time"""
+        return int(utc.localize(dt).astimezone(tz).utcoffset().total_seconds())
+
+    def find_timezones(self, offset, dt):
+        """Returns the bitmask of the time zones with the offset at dt, by checking all time zones"""
+        return self.zone_bits.mask(
+            name for name in all_timezones
+            if self.utc_offset(timezone(name), dt) == offset
+        )
 
-            future_tzs = {
-                tz.zone for tz in map(timezone, all_timezones_set)
-                if dt.astimezone(tz).utcoffset() == offset
-            }
-            if future_tzs != tzs:
-                dt = dt-td
-                break
-            if dt > maximum_date:
-                return tzs, dt-td
-
-        td = timedelta(hours=1)
-        while True:
-            dt += td
-
-            future_tzs = {
-                tz.zone for tz in map(timezone, all_timezones_set)
-                if dt.astimezone(tz).utcoffset() == offset
-            }
-            if dt > maximum_date or future_tzs != tzs:
-                return tzs, dt - td
+    def build(self):
+        """Build the table from the transitions of all time zones"""
+        changes = dd(list)
+        offsets = {}
+        for name in all_timezones:
+            tz = timezone(name)
+            offsets[name] = self.utc_offset(tz, self.start)
+            transitions = zip(getattr(tz, '_utc_transition_times', []), getattr(tz, '_transition_info', []))
+            for transition_time, (utcoffset, dst, tzname) in transitions:
+                if self.start < transition_time < self.end:
+                    changes[transition_time].append((name, int(utcoffset.total_seconds())))
+
+        zones_per_offset = dd(set)
+        for name, offset in offsets.items():
+            zones_per_offset[offset].add(name)
+        table = {
+            offset: ([self.start], [self.zone_bits.mask(zones)])
+            for offset, zones in zones_per_offset.items()
+        }
+
+        for transition_time in sorted(changes):
+            changed = set()
+            for name, offset in changes[transition_time]:
+                if offsets[name] != offset:
+                    zones_per_offset[offsets[name]].discard(name)
+                    zones_per_offset[offset].add(name)
+                    changed.update((offsets[name], offset))
+                    offsets[name] = offset
+            for offset in changed:
+                mask = self.zone_bits.mask(zones_per_offset[offset])
+                if offset not in table:
+                    table[offset] = ([], [])
+                starts, masks = table[offset]
+                if not masks or masks[-1] != mask:
+                    starts.append(transition_time)
+                    masks.append(mask)
+        return table
+
+    def save(self):
+        """Save the table. Several processes may build the table at once, each writes
+        to its own temporary file, so that load never reads a partly written table"""
+        try:
+            os.makedirs(os.path.dirname(self.file_path))
+        except OSError:
+            pass
+        tmp_file_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'w') as f:
+            json.dump({
+                'years': list(self.years),
+                'pytz': pytz_version,
+                'zones': list(self.zone_bits),
+                'offsets': {
+                    offset: [[start.isoformat(), format(mask, 'x')] for start, mask in zip(starts, masks)]
+                    for offset, (starts, masks) in self.table.items()
+                }
+            }, f)
+        os.replace(tmp_file_path, self.file_path)
+
+    def load(self):
+        """Load the table from disk, or build and save it if it does not exist or was
+        built for other years or another version of the time zone database"""
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as f:
+                data = json.load(f)
+            if data['years'] == list(self.years) and data['pytz'] == pytz_version and data['zones'] == list(self.zone_bits):
+                self.table = {
+                    int(offset): (
+                        [dates.isoformat_2_date(start) for start, mask in intervals],
+                        [int(mask, 16) for start, mask in intervals]
+                    )
+                    for offset, intervals in data['offsets'].items()
+                }
+                return
+        print("Building UTC offset to time zones table")
+        self.table = self.build()
+        self.save()
 
     def get_tz(self, offset, dt):
-        offset = timedelta(seconds=offset)
-        if not self[offset]:
-            tzs, end = self.find_timezones(offset, dt)
-            self[offset].append({
-                "tzs": tzs,
-                "start": datetime(1970, 1, 1),
-                "end": end
-            })
-            return tzs
-        else:
-            for tz in self[offset][::-1]:
-                if tz["end"] > dt >= tz["start"]:
-                    return tz["tzs"]
+        """Returns the bitmask of the time zones with the offset (in seconds) at dt"""
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(utc).replace(tzinfo=None)
+        if not self.start <= dt < self.end:
+            return self.find_timezones(offset, dt)
+        if self.table is None:
+            self.load()
+        try:
+            starts, masks = self.table[offset]
+        except KeyError:
+            return 0
+        i = bisect_right(starts, dt) - 1
+        if i < 0:
+            return 0
+        return masks[i]
+
+
+class TagStripper:
+    """Strips the tags of one language from ngrams. The tags are tried in reverse
+    lexicographic order (e.g. floods before flood) and only the first occurrence of
+    the first tag found is stripped. All tags are compiled in one pattern, that finds
+    the best ranked tag starting at each position of the ngram in a single scan"""
+    def __init__(self, tags):
+        self.tags = sorted(tags, reverse=True)
+        self.rank = {tag: i for i, tag in enumerate(self.tags)}
+        # Lookahead, so that overlapping tags are found as well
+        self.pattern = compile('(?=(' + '|'.join(escape(tag) for tag in self.tags) + '))')
+
+    def find(self, ngram):
+        """Returns the position and the tag to strip from the ngram, or None"""
+        best = None
+        for match in self.pattern.finditer(ngram.lower()):
+            tag = match.group(1)
+            if best is None or self.rank[tag] < self.rank[best[1]]:
+                best = match.start(), tag
+        return best
+
+    def strip(self, ngrams):
+        new_ngrams = []
+        subsetted_ngrams = set()
+        for ngram in ngrams:
+            found = self.find(ngram)
+            if found:
+                i, tag = found
+                new_ngram = (ngram[:i] + ngram[i + len(tag):]).strip().replace('  ', ' ')
+                new_ngrams.append(new_ngram)
+                subsetted_ngrams.add(new_ngram)
             else:
-                tzs, end = self.find_timezones(offset, dt)
-                self[offset].append({
-                    "tzs": tzs,
-                    "start": self[offset][-1]["end"],
-                    "end": end
-                })
-                return tzs
+                new_ngrams.append(ngram)
+        return new_ngrams, subsetted_ngrams
 
 
 class Base:
     def __init__(self, n_words):
         """In this function we load a lot of data that is used for analysis
-        of a tweet"""
+        of a tweet. The data is loaded from the prebuilt analyzer state if the inputs
+        it was built from did not change. Otherwise it is built and saved"""
+        # Run time of each loader (see timed)
+        self.startup_times = {}
+        start = time.perf_counter()
+
+        inputs = self._state_inputs()
+        if inputs is None:
+            print("Preprocessing steps are not recorded, building the analyzer state without saving it")
+            self._build_state()
+        elif not self._load_state(inputs):
+            attributes = set(self.__dict__)
+            self._build_state()
+            self._save_state(inputs, {
+                key: value for key, value in self.__dict__.items()
+                if key not in attributes
+            })
+
+        # Dictonary with most common words for each language (max 10000), loaded when
+        # first used. Not part of the state, so that analyzers with a different n_words
+        # share it
+        if n_words > 10000:
+            print("Can only download 1000 most common using this website - setting n to 1000")
+            n_words = 10000
+        self.most_common_words = PerLanguage(load_most_common_words, n_words)
+
+        self.startup_times['total'] = time.perf_counter() - start
+        self.print_startup_times()
+        self.print_area_metrics()
+
+    def _build_state(self):
+        """Load all data used for analysis from the input files and PostgreSQL"""
         # Get the tokens for analysis that we will limit the analysis to. If the
         # tweet text does not contain one of the tokens in this dictionary it is
         # discarded
         self.tags = self._get_tags()
+        # Strippers of the tags of a language are compiled when first used
+        self.tag_strippers = PerLanguage(load_tag_stripper, self.tags)
         self.toponym_capitalization = self._get_language_info()
 
         # The size order of the administrative levels. Can be used for sorting
         # locations by its size.
-        self.size_order = {
-            "continent": 0,
-            "country": 1,
-            "adm1": 2,
-            "town": 3
-        }
+        self.size_order = relations.SIZE_ORDER
 
         # List of timezones per content
         self.timezones_per_continent = self._get_timezones_per_continent()
         # A dictionary to convert Twitter time zones to official time zones
         self.tz_map = self._load_tz_map()
 
-        # The geometries of countries and continents
+        # The geometries of countries and continents, simplified at the chosen tolerance
+        self.area_tolerance = self._choose_area_tolerance(AREA_SIMPLIFICATION_TOLERANCE)
         countries, continents = self._load_adm_areas()
-        # Get a dictonary of the geometry and the bounding box of each country and continetn
+        # Get a dictonary of the geometry, the bounding box and the lookup grid of each country and continent
         self.paths = self._parse_paths(countries, continents)
         # A set of all the country geonameids
         self.country_geonameids = set(countries.keys())
@@ -160,84 +388,205 @@ class Base:
             else:
                 self.adm_names[name].update(geonameids)
 
-        # Dictonary with most common words for each language (max 10000)
-        self.most_common_words = self._get_most_common_words(n_words)
-
         self.offset2timezones = Offset2TimeZones()
+        # Bitmasks of the time zones of each continent and country (see match_offset)
+        self.time_zone_bits = self.offset2timezones.zone_bits
+        self.timezones_per_continent_mask = {
+            geonameid: self.time_zone_bits.mask(timezones)
+            for geonameid, timezones in self.timezones_per_continent.items()
+        }
+        self.time_zones_per_country_mask = {
+            geonameid: self.time_zone_bits.mask(timezones)
+            for geonameid, timezones in self.time_zones_per_country.items()
+        }
+
+    def _state_inputs(self, file_paths=ANALYZER_STATE_INPUT_FILES, steps=ANALYZER_STATE_INPUT_STEPS):
+        """Return what the analyzer state is built from: the version of the state, the
+        parameters, the checksums of the input files, the time the preprocessing steps
+        finished and the last update of the gazetteer. Returns None if the steps were
+        not recorded, as the content of the tables is then unknown"""
+        checksums = {}
+        for file_path in file_paths:
+            with open(file_path, 'rb') as f:
+                checksums[file_path] = hashlib.sha256(f.read()).hexdigest()
+        pg.cur.execute("SELECT to_regclass('preprocessing_steps') IS NOT NULL, to_regclass('geonames_updates') IS NOT NULL")
+        steps_exist, updates_exist = pg.cur.fetchone()
+        if not steps_exist:
+            return None
+        pg.cur.execute("SELECT name, finished FROM preprocessing_steps WHERE name IN %s", (tuple(steps), ))
+        finished = {name: finished.isoformat() for name, finished in pg.cur.fetchall()}
+        last_update = None
+        if updates_exist:
+            pg.cur.execute("SELECT MAX(day) FROM geonames_updates")
+            last_update, = pg.cur.fetchone()
+        return {
+            'version': ANALYZER_STATE_VERSION,
+            'parameters': {
+                'area_simplification_tolerance': AREA_SIMPLIFICATION_TOLERANCE,
+                'area_grid_cell_size': AREA_GRID_CELL_SIZE,
+                'time_zone_table_years': list(TIME_ZONE_TABLE_YEARS),
+                'pytz': pytz_version,
+                'languages': LANGUAGES
+            },
+            'files': checksums,
+            'steps': finished,
+            'last_update': last_update and last_update.isoformat()
+        }
+
+    @timed
+    def _load_state(self, inputs, file_path=ANALYZER_STATE_FILE):
+        """Load the analyzer state if it was built from inputs. The file holds the inputs
+        followed by the state, so that the state is only read if it is up to date.
+        Returns True if the state is loaded"""
+        try:
+            with open(file_path, 'rb') as f:
+                if pickle.load(f) != inputs:
+                    print("Analyzer state is out of date, rebuilding")
+                    return False
+                self.__dict__.update(pickle.load(f))
+        except FileNotFoundError:
+            return False
+        print("Loaded analyzer state")
+        return True
+
+    @timed
+    def _save_state(self, inputs, state, file_path=ANALYZER_STATE_FILE):
+        """Save the analyzer state together with the inputs it was built from. Several
+        processes may build the state at once, each writes to its own temporary file"""
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(inputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_path, file_path)
+
+    def print_startup_times(self):
+        """Print the run time of each loader"""
+        print("Startup times:")
+        for name, seconds in sorted(self.startup_times.items(), key=itemgetter(1), reverse=True):
+            print(f"\t{name}: {seconds:.2f}s")
+
+    def print_area_metrics(self):
+        """Print the tolerance of the geometries of the countries and continents and how
+        often the exact geometries were needed (see area_metrics)"""
+        metrics = self.area_metrics()
+        print(f"Areas: tolerance {metrics['tolerance']}, exact tests: {metrics['exact_tests']}, exact geometries loaded: {metrics['exact_loaded']}")
 
     def get_ngrams_space_separable(self, clean_text):
-        tokens = sanitize.tokenize(clean_text, remove_punctuation=True)
-        ngrams = sanitize.gramify(tokens, 1, 3)
-        return sanitize.discard_ngrams_with_digits(ngrams)
+        tokens = sanitize.tokenize_fast(clean_text, remove_punctuation=True)
+        return list(sanitize.gramify_fast(tokens, 1, 3, discard_digits=True))
 
     def get_ngrams(self, clean_text, lang):
         return self.get_ngrams_space_separable(clean_text)
 
+    @timed
     def _get_language_info(self):
+        import pandas as pd
         df = pd.read_excel('input/tables/languages.xlsx')
         toponym_capitalization = df.set_index('language_code')['toponym_captitalization'].replace('Yes', True).to_dict()
-        return toponym_capitalization
+        return {
+            language: capitalization
+            for language, capitalization in toponym_capitalization.items()
+            if LANGUAGES is None or language in LANGUAGES
+        }
 
+    @timed
     def _load_time_zones_per_country(self):
         """Returns a dictonary with a set of timezones for each country"""
-        pg.cur.execute("""
+        timezones = dd(set)
+        for geonameid, time_zone_loc_name in pg.stream("""
             SELECT countries.geonameid, time_zones_per_country.name
             FROM time_zones_per_country
             INNER JOIN countries
             ON time_zones_per_country.ISO2=countries.ISO2
-        """)
-        timezones = dd(set)
-        for geonameid, time_zone_loc_name in pg.cur.fetchall():
+        """):
             timezones[geonameid].add(time_zone_loc_name)
         return dict(timezones)
 
+    @timed
     def _get_timezones_per_continent(self):
         """Return a dictonary with a set of timezones for each continent"""
+        import pandas as pd
         df = pd.read_excel('input/tables/timezones_per_continent.xlsx')
+        # The columns have different lengths, so the table has empty cells
         return {
-            column: set(df[column])
+            column: set(name for name in df[column].dropna() if name in all_timezones_set)
             for column in df
         }
 
+    @timed
     def _load_adm1_geonameids(self):
         """Return the set of amd1 geonameids"""
         pg.cur.execute("""SELECT geonameid FROM adm1""")
         return set(geonameid for geonameid, in pg.cur.fetchall())
 
+    def _choose_area_tolerance(self, tolerance):
+        """Return the largest tolerance of the simplified areas made in preprocessing that is
+        not larger than tolerance, or 0 (the exact geometries) if there is none"""
+        if not tolerance:
+            return 0
+        pg.cur.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name='simplified_areas')")
+        if not pg.cur.fetchone()[0]:
+            return 0
+        pg.cur.execute("SELECT DISTINCT tolerance FROM simplified_areas WHERE tolerance <= %s", (tolerance, ))
+        return max((tolerance for tolerance, in pg.cur.fetchall()), default=0)
+
+    @timed
     def _load_adm_areas(self):
         """Return two dictionaries (countries and continents) with the
-        path of each administrative area"""
-        countries = {}
-
-        pg.cur.execute("SELECT geonameid, ST_AsText(geom) FROM countries")
-        for geonameid, wkt in pg.cur.fetchall():
-            if wkt:
-                geom = geo.wkt_to_geom(wkt)
-                path = geo.PolygonPath(geom)
-                countries[geonameid] = path
-
-        continents = {}
-        pg.cur.execute("SELECT geonameid, ST_AsText(geom) FROM continents")
-        for geonameid, wkt in pg.cur.fetchall():
-            if wkt:
-                geom = geo.wkt_to_geom(wkt)
-                path = geo.PolygonPath(geom)
-                continents[geonameid] = path
-
+        geometry of each administrative area, simplified at self.area_tolerance"""
+        areas = []
+        for table in ('countries', 'continents'):
+            if self.area_tolerance:
+                pg.cur.execute(f"""
+                    SELECT simplified_areas.geonameid, ST_AsText(simplified_areas.geom)
+                    FROM simplified_areas
+                    JOIN {table} ON simplified_areas.geonameid = {table}.geonameid
+                    WHERE tolerance = %s
+                """, (self.area_tolerance, ))
+            else:
+                pg.cur.execute(f"SELECT geonameid, ST_AsText(geom) FROM {table}")
+            areas.append({
+                geonameid: geo.wkt_to_geom(wkt)
+                for geonameid, wkt in pg.cur.fetchall()
+                if wkt
+            })
+        print(f"Loaded areas at tolerance {self.area_tolerance}")
+        countries, continents = areas
         return countries, continents
 
-    def _parse_paths(self, *args):
-        """Return a dictonary with the paths and bounding boxes for all input"""
+    @timed
+    def _parse_paths(self, countries, continents):
+        """Return a dictonary with the paths and lookup grids for all input. If the geometries
+        are simplified, the exact path is only loaded for tests near the border (see geo.AreaGrid)"""
         paths = {}
-        for adm_level in args:
-            for geonameid, path in adm_level.items():
-                bbox = path.get_extents()
+        for table, adm_level in (('countries', countries), ('continents', continents)):
+            for geonameid, geom in adm_level.items():
+                if self.area_tolerance:
+                    path = geo.LazyPath(load_exact_geom, table, geonameid)
+                else:
+                    path = geo.PolygonPath(geom)
                 paths[geonameid] = {
                     'path': path,
-                    'bbox': bbox
+                    'grid': geo.AreaGrid(geom, path, AREA_GRID_CELL_SIZE, self.area_tolerance)
                 }
         return paths
 
+    def area_metrics(self):
+        """Return the tolerance of the used geometries of the countries and continents, the
+        number of points tested against the exact geometries and the number of exact
+        geometries that are loaded"""
+        if self.area_tolerance:
+            n_loaded = sum(1 for area in self.paths.values() if area['path'].path is not None)
+        else:
+            n_loaded = len(self.paths)
+        return {
+            'tolerance': self.area_tolerance,
+            'exact_tests': sum(area['grid'].n_exact for area in self.paths.values()),
+            'exact_loaded': n_loaded
+        }
+
+    @timed
     def _load_tz_map(self):
         """Return a dictonary that translates a
         Twitter timezone to a official time zone"""
@@ -248,6 +597,7 @@ class Base:
             in pg.cur.fetchall()
         }
 
+    @timed
     def _load_country_2_continent(self):
         """Return a dictionary with the continent(s) a country is on"""
         pg.cur.execute("SELECT geonameid, continents FROM countries")
@@ -256,6 +606,7 @@ class Base:
             for country, continent in pg.cur.fetchall()
         }
 
+    @timed
     def _get_tags(self):
         """Return a dictonary with the tags used for analysis for each language
         The used tags can be changed in input/tags.txt"""
@@ -263,24 +614,22 @@ class Base:
             tags = dd(set)
             for line in f.readlines():
                 tag, language = line.decode().strip().replace(' ', '').split(',')
-                tags[language].add(tag)
+                if LANGUAGES is None or language in LANGUAGES:
+                    tags[language].add(tag)
         return dict(tags)
 
-    def _get_alternative_names_countries(self):
-        """Return a list of the alternative names for countries"""
-        names = dd(dict)
-        pg.cur.execute("""SELECT geonameid FROM countries""")
-        for geonameid, in pg.cur.fetchall():
-            pg.cur.execute(f"""SELECT name, full_name, population, country_geonameid, adm1_geonameid FROM geonames WHERE geonameid = {geonameid}""")
-            res = pg.cur.fetchone()
-            if res is None:
-                continue
-            name, full_name, population, country_geonameid, adm1_geonameid = res
-            if name not in names:
-                names[name] = {}
-
+    def _get_alternative_names(self, location_type, selection):
+        """Return a dictionary with for each name and alternative name of the locations
+        with a geonameid in selection (an SQL subquery) the locations bearing it"""
+        names = {}
+        locations = {}
+        for geonameid, name, population, country_geonameid, adm1_geonameid in pg.stream(f"""
+            SELECT geonameid, name, population, country_geonameid, adm1_geonameid
+            FROM geonames
+            WHERE geonameid IN ({selection})
+        """):
             geonameid_info = {
-                'type': 'country',
+                'type': location_type,
                 'abbreviations': [],
                 "toponym": name,
                 "geonameid": geonameid,
@@ -288,22 +637,33 @@ class Base:
                 "country_geonameid": country_geonameid,
                 "adm1_geonameid": adm1_geonameid
             }
-            names[name][geonameid] = geonameid_info
-
-            pg.cur.execute(f"""SELECT alternate_name, isolanguage, full_name FROM alternate_names WHERE geonameid = {geonameid}""")
-            for name, isolanguage, full_name in pg.cur.fetchall():
-                if name not in names:
-                    names[name] = {}
-                if geonameid not in names[name]:
-                    names[name][geonameid] = geonameid_info
-                if isolanguage == 'abbr':
-                    names[name][geonameid]['abbreviations'].append(full_name)
+            locations[geonameid] = geonameid_info
+            names.setdefault(name, {})[geonameid] = geonameid_info
+
+        for geonameid, name, isolanguage, full_name in pg.stream(f"""
+            SELECT geonameid, alternate_name, isolanguage, full_name
+            FROM alternate_names
+            WHERE geonameid IN ({selection})
+        """):
+            # Only alternative names of locations in the geonames table
+            try:
+                geonameid_info = locations[geonameid]
+            except KeyError:
+                continue
+            names.setdefault(name, {}).setdefault(geonameid, geonameid_info)
+            if isolanguage == 'abbr':
+                geonameid_info['abbreviations'].append(full_name)
         return names
 
+    @timed
+    def _get_alternative_names_countries(self):
+        """Return a list of the alternative names for countries"""
+        return self._get_alternative_names('country', "SELECT geonameid FROM countries")
+
+    @timed
     def _get_alternative_names_adm1(self):
         """Return a list of the alternative names for adm1"""
-        names = dd(set)
-        pg.cur.execute("""
+        return self._get_alternative_names('adm1', """
             SELECT geonameid
             FROM geonames
             WHERE feature_code IN ('ADM1', 'ADM1H', 'ADM2', 'ADM2H')
@@ -311,35 +671,6 @@ class Base:
                     SELECT adm1.geonameid FROM adm1
                 )
         """)
-        for geonameid, in pg.cur.fetchall():
-            pg.cur.execute(f"""SELECT name, full_name, population, country_geonameid, adm1_geonameid FROM geonames WHERE geonameid = {geonameid}""")
-            res = pg.cur.fetchone()
-            if res is None:
-                continue
-            name, full_name, population, country_geonameid, adm1_geonameid = res
-            if name not in names:
-                names[name] = {}
-
-            geonameid_info = {
-                'type': 'adm1',
-                'abbreviations': [],
-                "toponym": name,
-                "geonameid": geonameid,
-                "population": population,
-                "country_geonameid": country_geonameid,
-                "adm1_geonameid": adm1_geonameid
-            }
-            names[name][geonameid] = geonameid_info
-
-            pg.cur.execute(f"""SELECT alternate_name, isolanguage, full_name FROM alternate_names WHERE geonameid = {geonameid}""")
-            for name, isolanguage, full_name in pg.cur.fetchall():
-                if name not in names:
-                    names[name] = {}
-                if geonameid not in names[name]:
-                    names[name][geonameid] = geonameid_info
-                if isolanguage == 'abbr':
-                    names[name][geonameid]['abbreviations'].append(full_name)
-        return names
 
     def _get_all_ngrams(self, language):
         """Generator that yields all ngrams from database for a certain language"""
@@ -373,27 +704,6 @@ class Base:
                     yield n_gram
         print()
 
-    def _get_most_common_words(self, n):
-        """Read n (max = 10000) most common words from the database"""
-        if n > 10000:
-            print("Can only download 1000 most common using this website - setting n to 1000")
-            n = 10000
-
-        pg.cur.execute("""SELECT name FROM geonames WHERE population > 100000""")
-        places_high_population = set(name for name, in pg.cur.fetchall())
-
-        d = {}
-        pg.cur.execute("""SELECT DISTINCT language FROM most_common_words""")
-        for language, in pg.cur.fetchall():
-            d[language] = set()
-            pg.cur.execute(f"""SELECT word FROM most_common_words WHERE language = '{language}' ORDER BY n ASC LIMIT {n}""")
-            for word, in pg.cur.fetchall():
-                word = word.lower()
-                if word not in places_high_population:
-                    d[language].add(word)
-
-        return d
-
 
 class TweetAnalyzer(TweetAnalyzerCustom, Base):
     """This class is meant to take a tweet analyze it and return data regarding the
@@ -404,14 +714,62 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
         """Set some initial values and call the __init__ of the its parent classes"""
         self.min_population_capitalized = min_population_capitalized
         self.min_population_non_capitalized = min_population_non_capitalized
+        # Scores given for metadata matches. When raw_scores is set, duplicate
+        # and family detection is skipped, so that these can be done later
+        # with different settings (see geotag.sweep)
+        self.score_types = SCORE_TYPES
+        self.raw_scores = False
         Base.__init__(self, n_words)
 
         self.lastuserlocationdict = LastUserLocationDict(10000)
-
-    def extract_user_locations_child(self, child, original_name, parent_name, parent_info):
+        # The most frequent user locations, resolved in advance
+        self.preresolved_user_locations = self._load_user_locations()
+        # Cache of analyze_text for retweets and copies
+        self.text_cache = LastUserLocationDict(TEXT_CACHE_SIZE)
+
+    def _load_user_locations(self, file_path=USER_LOCATIONS_FILE):
+        """Returns a dictionary with the user locations resolved by geotag.user_locations,
+        or an empty dictionary if these are not available"""
         try:
-            locations = es_toponyms.get(index=TOPONYM_INDEX, doc_type='unique_name', id=child)['_source']['locations']
+            with open(file_path) as f:
+                user_locations = json.load(f)
+        except FileNotFoundError:
+            return {}
+        for locations in user_locations.values():
+            for loc in locations:
+                # Convert coordinates to tuple as in get_location_type
+                if loc.get('coordinates') is not None:
+                    loc['coordinates'] = tuple(loc['coordinates'])
+        print(f"Loaded {len(user_locations)} resolved user locations")
+        return user_locations
+
+    def get_toponym_locations(self, name, documents=None):
+        """Returns the locations bearing a name in the toponym index, or None if the name
+        is not in the index. If documents (see get_toponyms) are given, the locations are
+        taken from these instead"""
+        if documents is not None:
+            locations = documents.get(name)
+            if locations is None:
+                return None
+            return [dict(loc) for loc in locations]
+        try:
+            return es_toponyms.get(index=TOPONYM_INDEX, doc_type='unique_name', id=name)['_source']['locations']
         except (elasticsearch.exceptions.NotFoundError, ValueError):
+            return None
+
+    def get_toponyms(self, names):
+        """Returns a dictionary with the locations of all names that are found in the toponym index"""
+        documents = {}
+        names = [name for name in names if name]
+        for chunk in function.chunker(names, 10000):
+            for doc in es_toponyms.mget(index=TOPONYM_INDEX, doc_type='unique_name', body={'ids': chunk})['docs']:
+                if doc['found'] is True:
+                    documents[doc['_id']] = doc['_source']['locations']
+        return documents
+
+    def extract_user_locations_child(self, child, original_name, parent_name, parent_info, documents=None):
+        locations = self.get_toponym_locations(child, documents)
+        if locations is None:
             return [parent_info]
         else:
             locations = sorted(locations, key=itemgetter('population'), reverse=True)
@@ -426,10 +784,9 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 else:
                     return [parent_info]
 
-    def find_user_location_town(self, name, original_name):
-        try:
-            locations = es_toponyms.get(index=TOPONYM_INDEX, doc_type='unique_name', id=name)['_source']['locations']
-        except (elasticsearch.exceptions.NotFoundError, ValueError):
+    def find_user_location_town(self, name, original_name, documents=None):
+        locations = self.get_toponym_locations(name, documents)
+        if locations is None:
             return []
         else:
             locations = sorted(locations, key=itemgetter('population'), reverse=True)
@@ -445,27 +802,28 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 else:
                     return []
 
-    def find_user_location(self, u_location):
+    def find_user_location(self, u_location, documents=None):
         """Parses the location field of the user. The user field is split at a comma if present. If a comma is present,
         it is assumed that the part before the comma is the city and the second part the country. If no comma is present
         we assume that the user field specifies the country. The function returns False if not location is found, and a tuple
-        otherwise. Either ('country', geonameid) or ('place', [..., ...])"""
+        otherwise. Either ('country', geonameid) or ('place', [..., ...]). If documents are given, the toponym index
+        is not queried (see find_user_locations)"""
         if not u_location:
             return []
 
         if '/' in u_location:
             return [
-                loc for split in u_location.split('/') for loc in self.find_user_location(split)
+                loc for split in u_location.split('/') for loc in self.find_user_location(split, documents)
             ]
 
         if ' and ' in u_location:
             return [
-                loc for split in u_location.split(' and ') for loc in self.find_user_location(split)
+                loc for split in u_location.split(' and ') for loc in self.find_user_location(split, documents)
             ]
 
         if '&' in u_location:
             return [
-                loc for split in u_location.split('&') for loc in self.find_user_location(split)
+                loc for split in u_location.split('&') for loc in self.find_user_location(split, documents)
             ]
 
         u_location = u_location.strip().replace('.', '')
@@ -491,14 +849,14 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                     if parent_geonameids:
                         break
             else:
-                return self.find_user_location_town(u_location_lower, u_location)
+                return self.find_user_location_town(u_location_lower, u_location, documents)
             child = u_location_lower[:-len(name)].strip()
             if child:
                 original_name_i = u_location_lower.index(child)
                 original_name = u_location[original_name_i:original_name_i+len(child)]
                 locations = []
                 for parent_geonameid, parent_info in parent_geonameids.items():
-                    locations.extend(self.extract_user_locations_child(child, name, original_name, parent_info))
+                    locations.extend(self.extract_user_locations_child(child, name, original_name, parent_info, documents))
                 return locations
             else:
                 return parent_geonameids.values()
@@ -508,7 +866,7 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             try:
                 parent_geonameids = self.adm_names[parent]
             except KeyError:
-                return self.find_user_location_town(parent, u_location.split(',')[-1].strip())
+                return self.find_user_location_town(parent, u_location.split(',')[-1].strip(), documents)
             original_parent_name = u_location.split(',')[-1].strip()
             parent_geonameids = {
                 geonameid: geonameid_info
@@ -517,17 +875,55 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 if not geonameid_info['abbreviations'] or original_parent_name in geonameid_info['abbreviations']
             }
             if not parent_geonameids:
-                return self.find_user_location_town(parent, original_parent_name)
+                return self.find_user_location_town(parent, original_parent_name, documents)
             locations = []
             for parent_geonameid, parent_info in parent_geonameids.items():
-                locations.extend(self.extract_user_locations_child(child, parent, original_parent_name, parent_info))
+                locations.extend(self.extract_user_locations_child(child, parent, original_parent_name, parent_info, documents))
             return locations
         elif len(u_location_splitted_comma) == 3:
             u_location_original_splitted = u_location.split(',')
-            return self.find_user_location(' '.join([u_location_original_splitted[0] + u_location_original_splitted[-2]]))
+            return self.find_user_location(' '.join([u_location_original_splitted[0] + u_location_original_splitted[-2]]), documents)
         else:
             return []
 
+    def find_user_locations(self, u_locations):
+        """Parses a batch of user location fields with a single lookup of all names in the
+        toponym index. The parsing is first done without documents to collect the names
+        it needs. Returns a dictionary with the locations of each user location field"""
+        requests = ToponymRequests()
+        for u_location in u_locations:
+            self.find_user_location(u_location, requests)
+        documents = self.get_toponyms(requests)
+        return {
+            u_location: self.find_user_location(u_location, documents)
+            for u_location in u_locations
+        }
+
+    def prefetch_user_locations(self, tweets):
+        """Resolves the user locations of a page of tweets (not yet parsed) in one batch and
+        stores them in lastuserlocationdict, where analyze_tweet finds them. Only the user
+        locations of tweets with toponyms in the text are resolved. The tweets are parsed
+        as in analyze_tweet, from a copy because parse_tweet changes the source"""
+        u_locations = set()
+        for tweet in tweets:
+            _, tweet = self.parse_tweet({**tweet, '_source': dict(tweet['_source'])})
+            if tweet['lang'] not in self.tags:
+                continue
+            u_location = tweet['user'].get('location')
+            if (
+                not u_location
+                or u_location in self.preresolved_user_locations
+                or u_location in self.lastuserlocationdict
+                or u_location in u_locations
+            ):
+                continue
+            clean_text, text_analysis = self.analyze_text_cached(tweet['text'], tweet['lang'])
+            if text_analysis is not None:
+                u_locations.add(u_location)
+        if u_locations:
+            for u_location, user_locations in self.find_user_locations(u_locations).items():
+                self.lastuserlocationdict[u_location] = user_locations
+
     def find_time_zones_tweet(self, tweet):
         return self.offset2timezones.get_tz(tweet['user']['utc_offset'], tweet['date'])
 
@@ -537,7 +933,7 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             area = self.paths[geonameid]
         except KeyError:
             return False
-        return area['bbox'].contains(*coordinate) and area['path'].contains_point(coordinate)
+        return area['grid'].contains(coordinate)
 
     def is_family(self, loc1, loc2, toponym1, toponym2, siblings=True, consider_toponym_length=True, consider_population=False):
         """Checks if 2 locations are "family". This can be geographical parent-child, or siblings.
@@ -583,25 +979,30 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 else:
                     return locs[0]['geonameid'] == locs[1]['adm1_geonameid'] or locs[0]['adm1_geonameid'] == locs[1]['adm1_geonameid']
 
-    def match_coordinates(self, location, tweet):
-        """Returns true if a tweet is sent out from within the given locations, else False"""
-        if location['type'] == 'continent':
-            return self.area_contains(location['geonameid'], tweet['coordinates'])
-        if location['type'] == 'town':
-            return spatial.distance_coords(tweet['coordinates'], location['coordinates']) < MAX_DISTANCE_CITY_COORDINATE
-        else:
-            return self.area_contains(location['country_geonameid'], tweet['coordinates'])
+    def match_locations(self, locations, coordinate, max_distance):
+        """Returns for each location if the coordinate is within the location: within
+        max_distance of a town, otherwise within its continent or country. The distances
+        between the coordinate and all locations are computed in one call"""
+        distances = spatial.distances_coords(coordinate, [loc['coordinates'] for loc in locations])
+        matches = []
+        for loc, distance in zip(locations, distances):
+            if loc['type'] == 'continent':
+                matches.append(self.area_contains(loc['geonameid'], coordinate))
+            elif loc['type'] == 'town':
+                matches.append(distance < max_distance)
+            else:
+                matches.append(self.area_contains(loc['country_geonameid'], coordinate))
+        return matches
+
+    def match_coordinates_locations(self, locations, tweet):
+        """Returns for each location if the tweet is sent out from within the location"""
+        return self.match_locations(locations, tweet['coordinates'], MAX_DISTANCE_CITY_COORDINATE)
 
-    def match_bbox(self, location, tweet):
-        """Returns true if a tweet is sent out from within the given locations, else False"""
+    def match_bbox_locations(self, locations, tweet):
+        """Returns for each location if the center of the tweet bbox is within the location"""
         bbox = tweet['bbox']
         bbox_center = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
-        if location['type'] == 'continent':
-            return self.area_contains(location['geonameid'], bbox_center)
-        elif location['type'] == 'town':
-            return spatial.distance_coords(bbox_center, location['coordinates']) < MAX_DISTANCE_BBOX_CENTER
-        else:
-            return self.area_contains(location['country_geonameid'], bbox_center)
+        return self.match_locations(locations, bbox_center, MAX_DISTANCE_BBOX_CENTER)
 
     def match_timezones(self, location, tweet):
         """Checks if a tweets timezone corresponds with a locations time zone"""
@@ -630,21 +1031,21 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             return False
 
     def match_offset(self, location, timezones):
+        """Checks if the time zones of a location are in the bitmask of time zones with
+        the UTC offset of the tweet"""
         if location['type'] == 'continent':
             try:
-                continent_timezones = self.timezones_per_continent[location['geonameid']]
-                return len(timezones & continent_timezones) > 0
+                return bool(self.timezones_per_continent_mask[location['geonameid']] & timezones)
             except KeyError:
                 return False
         elif location['type'] == 'country':
             try:
-                country_timezones = self.time_zones_per_country[location['geonameid']]
-                return len(timezones & country_timezones) > 0
+                return bool(self.time_zones_per_country_mask[location['geonameid']] & timezones)
             except KeyError:
                 print(f"Could not find {location['geonameid']} in country timezones")
                 return False
         else:
-            return location['time_zone'] in timezones
+            return bool(self.time_zone_bits.get(location['time_zone'], 0) & timezones)
 
     def match_user_locations(self, location, toponym, user_locations):
         """Returns true if a user location mathes given location"""
@@ -658,78 +1059,93 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             return 0
 
     def get_location_type(self, loc):
-        """Returns the type (town, country, amd1 or continent) of a location, based on its characteristics in the database"""
-        if loc['feature_code'] in set(['PPL', 'PPLA', 'PPLA2', 'PPLA3', 'PPLA4', 'PPLC', 'PPLG', 'PPLR', 'PPLS', 'STLMT']):
-            loc['type'] = 'town'
+        """Returns the location with its type (town, country, amd1 or continent), based on its
+        characteristics in the database, or None if it has none. The type is stored with the
+        location in the toponym index, for older indices it is determined here"""
+        if 'type' in loc:
+            location_type = loc['type']
+        else:
+            location_type = relations.location_type(loc['feature_code'], loc['geonameid'], self.adm1_map_geonameids)
+            loc['type'] = location_type
+        if location_type is None:
+            return None
+        if location_type == 'town':
             # Convert coordinates to tuple: more efficient for later analysis
             loc['coordinates'] = (loc['coordinates'][0], loc['coordinates'][1])
-            return loc
-        if loc['feature_code'] in ['ADM1', 'ADM1H', 'ADM2', 'ADM2H'] or loc['geonameid'] in self.adm1_map_geonameids:
-            loc['type'] = 'adm1'
-            return loc
-        if loc['feature_code'] == 'PCLI':
-            loc['type'] = 'country'
-            return loc
-        if loc['feature_code'] == 'CONT':
-            loc['type'] = 'continent'
-            return loc
-        return None
+        return loc
 
     def is_near(self, loc1, loc2):
         """Returns true if two locations are nearby"""
         if loc1['type'] == 'town' and loc2['type'] == 'town':
-            return spatial.distance_coords(loc1['coordinates'], loc2['coordinates']) < NEAR_DISTANCE
+            (lon1, lat1), (lon2, lat2) = loc1['coordinates'], loc2['coordinates']
+            return bool(spatial.haversine(lon1, lat1, lon2, lat2) < NEAR_DISTANCE)
         else:
             return False
 
-    def strip_tags(self, ngrams, tags):
-        new_ngrams = []
-        subsetted_ngrams = set()
-        for ngram in ngrams:
-            subsetted = False
-            for tag in tags:
-                while True:
-                    try:
-                        i = ngram.lower().index(tag)
-                    except ValueError:
-                        break
-                    else:
-                        new_ngram = (ngram[:i] + ngram[i + len(tag):]).strip().replace('  ', ' ')
-                        new_ngrams.append(new_ngram)
-                        subsetted_ngrams.add(new_ngram)
-                        subsetted = True
-                        break
-                if subsetted:
-                    break
+    def discard_family_duplicates(self, doc_locations, toponym):
+        """If multiple locations bear the same name and are family, only keep
+        the one with the highest number of translations in the geonames
+        database. This is a proxy for the importance of the locations. On a tie
+        the largest location is kept. For the locations in the toponym index this
+        is decided in advance (see relations.dominated_by)"""
+        if len(doc_locations) > 1:
+            if all('dominated_by' in loc for loc in doc_locations):
+                present = set(loc['geonameid'] for loc in doc_locations)
+                to_discard = set(
+                    loc['geonameid'] for loc in doc_locations
+                    if any(geonameid in present for geonameid in loc['dominated_by'])
+                )
             else:
-                new_ngrams.append(ngram)
-        return new_ngrams, subsetted_ngrams
+                to_discard = set(
+                    discard['geonameid']
+                    for keep, discard in relations.family_duplicates(doc_locations, self.country_2_continent)
+                )
+            if to_discard:
+                doc_locations = [
+                    loc for loc in doc_locations
+                    if loc['geonameid'] not in to_discard
+                ]
+        return doc_locations
+
+    def match_family(self, tweet_toponyms, toponym, doc_locations, score):
+        """Check the locations of a toponym for family with the locations of the
+        toponyms already found in the tweet. If family is true, set both to score"""
+        indices = {}
+        for tweet_toponym, geonameids in tweet_toponyms.items():
+            long_toponyms = len(toponym) >= 7 and len(tweet_toponym) >= 7
+            if long_toponyms not in indices:
+                indices[long_toponyms] = relations.index_family(doc_locations, self.country_2_continent, long_toponyms=long_toponyms)
+            parents, children = indices[long_toponyms]
+            for loc1 in geonameids.values():
+                parent_keys, child_keys = relations.family_keys(loc1, self.country_2_continent, long_toponyms=long_toponyms)
+                family = [loc2 for key in parent_keys for loc2 in children.get(key, [])]
+                family.extend(loc2 for key in child_keys for loc2 in parents.get(key, []))
+                if family:
+                    loc1['family'] = score
+                    for loc2 in family:
+                        loc2['family'] = score
+
+    def strip_tags(self, ngrams, lang):
+        """Remove the tags of the language from the ngrams. Returns the new ngrams
+        and the set of ngrams from which a tag was stripped"""
+        return self.tag_strippers[lang].strip(ngrams)
 
     def find_first_letter_original_ngram(self, text, ngram):
         return text[text.lower().index(ngram)]
 
     def get_ngrams_space_separable(self, clean_text):
-        tokens = sanitize.tokenize(clean_text, remove_punctuation=True)
-        ngrams = sanitize.gramify(tokens, 1, 3)
-        return sanitize.discard_ngrams_with_digits(ngrams)
-
-    def analyze_tweet(self, tweet, index=None):
-        """This function takes as input a tweet and returns the tweet metadata that
-        is important further down the line and the potential locations of a tweet"""
-        tweet_id, tweet = self.parse_tweet(tweet)
-        clean_text = sanitize.clean_text(tweet['text'], lower=False)
+        tokens = sanitize.tokenize_fast(clean_text, remove_punctuation=True)
+        return list(sanitize.gramify_fast(tokens, 1, 3, discard_digits=True))
+
+    def analyze_text(self, clean_text, lang):
+        """Returns the text-derived part of the analysis of a tweet: the original
+        casing of the ngrams, the ngrams from which a tag was stripped and the found
+        toponyms with their documents from the gazetteer. Returns None if no toponyms
+        are found"""
         ngrams = self.get_ngrams_space_separable(clean_text)
 
-        # Get all the tags for analysis in a language. Sort them by lenght.
-        # This is important because all keywords a tweet is found by are removed
-        # before futher analysis.
-        try:
-            tags = sorted(self.tags[tweet['lang']], reverse=True)
-        except KeyError:
-            return None
-
         # Remove all tags from the tokens
-        ngrams, subsetted_ngrams = self.strip_tags(ngrams, tags)
+        ngrams, subsetted_ngrams = self.strip_tags(ngrams, lang)
 
         ngrams = [ngram for ngram in ngrams if ngram]
 
@@ -750,7 +1166,7 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             ngram for ngram in lower_case_ngrams if (
                 ngram in self.country_alternative_names_set or (
                     len(ngram) >= MINIMUM_GRAM_LENGTH and
-                    ngram not in self.most_common_words[tweet['lang']]
+                    ngram not in self.most_common_words[lang]
                 )
             )
         )
@@ -786,31 +1202,79 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                         else:
                             topynym_in_toponym.add(ngram)
 
-        user_locations = None
-        timezones = None
-        tweet_toponyms = {}
-        toponym_capitalization = self.toponym_capitalization[tweet['lang']]
+        toponym_capitalization = self.toponym_capitalization[lang]
         if toponym_capitalization:
             first_word_sentences = first_word_recognizer.findall(clean_text)
             first_word_sentences = set(word.lower() for word in first_word_sentences)
 
-        # Loop through all documents
+        toponyms = []
         for doc in documents:
             toponym = doc['_id']
 
             # Do not consider if toponym is part of other toponym
-            if toponym in topynym_in_toponym or toponym in tags:
+            if toponym in topynym_in_toponym or toponym in self.tags[lang]:
                 continue
 
-            # Discard all locations with a population lower than self.min_population
-            if toponym_capitalization and toponym not in first_word_sentences and ngrams_orgininal[toponym].istitle():
+            # Capitalized toponyms use a different minimum population
+            capitalized = bool(toponym_capitalization and toponym not in first_word_sentences and ngrams_orgininal[toponym].istitle())
+            toponyms.append((toponym, doc['_source']['locations'], capitalized))
+
+        return {
+            'ngrams_orgininal': ngrams_orgininal,
+            'subsetted_ngrams': subsetted_ngrams,
+            'toponyms': toponyms
+        }
+
+    def analyze_text_cached(self, text, lang):
+        """Returns the clean text and the result of analyze_text. Retweets and copies of
+        tweets share the same text, so the results are cached by the original text and
+        the clean text, and the language"""
+        try:
+            return self.text_cache.getandmove((text, lang))
+        except KeyError:
+            pass
+        clean_text = sanitize.clean_text_fast(text, lower=False)
+        try:
+            result = self.text_cache.getandmove((clean_text, lang))
+        except KeyError:
+            result = clean_text, self.analyze_text(clean_text, lang)
+            self.text_cache[(clean_text, lang)] = result
+        if text != clean_text:
+            self.text_cache[(text, lang)] = result
+        return result
+
+    def analyze_tweet(self, tweet, index=None):
+        """This function takes as input a tweet and returns the tweet metadata that
+        is important further down the line and the potential locations of a tweet"""
+        tweet_id, tweet = self.parse_tweet(tweet)
+
+        # Only tweets in a language with tags are analyzed. All keywords a tweet
+        # is found by are removed before futher analysis (see strip_tags)
+        if tweet['lang'] not in self.tags:
+            return None
+
+        clean_text, text_analysis = self.analyze_text_cached(tweet['text'], tweet['lang'])
+        if text_analysis is None:
+            return None
+        ngrams_orgininal = text_analysis['ngrams_orgininal']
+        subsetted_ngrams = text_analysis['subsetted_ngrams']
+
+        user_locations = None
+        timezones = None
+        tweet_toponyms = {}
+
+        # Loop through all toponyms
+        for toponym, locations, capitalized in text_analysis['toponyms']:
+            # Discard all locations with a population lower than self.min_population.
+            # The locations are copied, because the documents are shared by all tweets with the same text
+            if capitalized:
                 doc_locations = [
-                    loc for loc in doc['_source']['locations']
+                    dict(loc) for loc in locations
                     if loc['population'] >= self.min_population_capitalized
                 ]
             else:
                 doc_locations = [
-                    loc for loc in doc['_source']['locations']
+                    dict(loc) for loc in locations
                     if loc['population'] >= self.min_population_non_capitalized
                 ]
 
@@ -818,33 +1282,14 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             doc_locations = list(filter(None, map(self.get_location_type, doc_locations)))
             if not doc_locations:
                 continue
-            # If multiple locations bear the same name and are family, only keep
-            # the one with the highest number of translations in the geonames
-            # database. This is a proxy for the importance of the locations
-            if len(doc_locations) > 1:
-                to_discard = set()
-                for loc1, loc2 in combinations(doc_locations, 2):
-                    if self.is_family(loc1, loc2, toponym, toponym, siblings=False, consider_toponym_length=False):
-                        sorted_locs = sorted(
-                            sorted(
-                                [loc1, loc2],
-                                key=lambda val: self.size_order[val['type']]
-                            ),
-                            key=lambda val: val['translations'],
-                            reverse=True
-                        )
-                        to_discard.add(sorted_locs[1]['geonameid'])
-                if to_discard:
-                    doc_locations = [
-                        loc for loc in doc_locations
-                        if loc['geonameid'] not in to_discard
-                    ]
+            if not self.raw_scores:
+                doc_locations = self.discard_family_duplicates(doc_locations, toponym)
 
             # match tweet coordinates
             if 'coordinates' in tweet and tweet['coordinates']:
-                for loc in doc_locations:
-                    if self.match_coordinates(loc, tweet):
-                        loc['coordinates match'] = SCORE_TYPES['coordinates match']
+                for loc, match in zip(doc_locations, self.match_coordinates_locations(doc_locations, tweet)):
+                    if match:
+                        loc['coordinates match'] = self.score_types['coordinates match']
                     else:
                         loc['coordinates match'] = 0
             else:
@@ -866,7 +1311,7 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 if timezones:
                     for loc in doc_locations:
                         if self.match_offset(loc, timezones):
-                            loc['utc_offset'] = SCORE_TYPES['utc_offset']
+                            loc['utc_offset'] = self.score_types['utc_offset']
                         else:
                             loc['utc_offset'] = 0
                 else:
@@ -880,7 +1325,9 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             if 'location' in tweet['user']:
                 if user_locations is None:
                     user_locations_str = tweet['user']['location']
-                    if user_locations_str:
+                    if user_locations_str in self.preresolved_user_locations:
+                        user_locations = self.preresolved_user_locations[user_locations_str]
+                    elif user_locations_str:
                         try:
                             user_locations = self.lastuserlocationdict.getandmove(user_locations_str)
                         except KeyError:
@@ -892,7 +1339,7 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                 if user_locations:
                     for loc in doc_locations:
                         if self.match_user_locations(loc, toponym, user_locations):
-                            loc['user home'] = SCORE_TYPES['user home']
+                            loc['user home'] = self.score_types['user home']
                         else:
                             loc['user home'] = 0
                 else:
@@ -905,9 +1352,9 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
             # Match tweet bounding box
             # Do not consider a bounding box if a coordinate is already present.
             if 'bbox' in tweet and tweet['bbox'] and 'coordinates' not in tweet:
-                for loc in doc_locations:
-                    if self.match_bbox(loc, tweet):
-                        loc['bbox'] = SCORE_TYPES['bbox']
+                for loc, match in zip(doc_locations, self.match_bbox_locations(doc_locations, tweet)):
+                    if match:
+                        loc['bbox'] = self.score_types['bbox']
                     else:
                         loc['bbox'] = 0
             else:
@@ -919,14 +1366,8 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
 
             # If other locaions are already added to the tweet_toponyms we can
             # check for family. If family is true, set both to True
-            if tweet_toponyms:
-                for tweet_toponym, geonameids in tweet_toponyms.items():
-                    for geonameid, loc1 in geonameids.items():
-                        for loc2 in doc_locations:
-                            # Geonameid is not saved as a key-value-pair. Thus we need to add the geonameid to the dictonary before passing loc1 and loc2 to self.is_family()
-                            if self.is_family(loc1, loc2, toponym, tweet_toponym, siblings=False, consider_population=True):
-                                loc1['family'] = SCORE_TYPES['family']
-                                loc2['family'] = SCORE_TYPES['family']
+            if tweet_toponyms and not self.raw_scores:
+                self.match_family(tweet_toponyms, toponym, doc_locations, self.score_types['family'])
 
             # Collect all neccesary information for each location and add it to the dictonary
             locs_information = {}
@@ -946,7 +1387,9 @@ class TweetAnalyzer(TweetAnalyzerCustom, Base):
                     'geonameid': loc['geonameid'],
                     'population': loc['population'],
                     'coordinates': loc['coordinates'],
-                    'abbreviations': loc['abbreviations']
+                    'abbreviations': loc['abbreviations'],
+                    'translations': loc['translations'],
+                    'capitalized': capitalized
                 }
 
             tweet_toponyms[toponym] = locs_information
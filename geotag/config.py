@@ -1,7 +1,8 @@
 import os
 import sys
+import time
 from operator import itemgetter
-from methods import dates
+from methods import dates, function
 
 from db.elastic import Elastic
 from db.postgresql import PostgreSQL
@@ -15,6 +16,21 @@ if not GEONAMES_USERNAME:
 GEONAMES_DIR = os.path.join('input', 'GeoNames')
 # Refresh the GeoNames data on new preprocessing run
 REFRESH_GEONAMES_TABLES = False
+# Folder with the daily GeoNames update files (e.g. fixtures) used instead of downloading
+# them when updating the gazetteer (python preprocessing.py update). None to download them
+GEONAMES_UPDATES_DIR = None
+# Number of processes used to match the geonames with their time zone and adm1 in Python
+# (see methods.geo.spatial_join). None to match them with a single UPDATE in PostGIS
+SPATIAL_JOIN_PROCESSES = None
+# Folder with the responses of the GeoNames children web service (one XML file for each
+# geonameid), which are used instead of querying the web service again. With
+# GEONAMES_OFFLINE, only these are used and the web service is never queried
+GEONAMES_CHILDREN_DIR = os.path.join(GEONAMES_DIR, 'children')
+GEONAMES_OFFLINE = False
+# Maximum number of requests to the GeoNames web service per hour (1000 for a free account)
+# and the number of requests at the same time
+GEONAMES_REQUESTS_PER_HOUR = 1000
+GEONAMES_THREADS = 4
 # Max lenght of n-grams to use for toponym recognition
 MAX_NGRAM_LENGTH = 3
 # Minimum lenght of one n-gram
@@ -27,6 +43,12 @@ MAX_DISTANCE_ENTITIES_IN_SAME_TWEET = 200000  # m
 MAX_DISTANCE_BBOX_CENTER = 200000  # m
 # A tweet coodrindate and entity are considered a match if closer than:
 MAX_DISTANCE_CITY_COORDINATE = 200000  # m
+# Cell size of the lookup grids for point in polygon tests of countries and continents
+AREA_GRID_CELL_SIZE = 0.25  # degrees
+# Tolerances of the simplified geometries of countries and continents made in preprocessing,
+# and the tolerance of the geometries used by the analyzer (0 for the exact geometries)
+AREA_SIMPLIFICATION_TOLERANCES = (0.01, 0.05)  # degrees
+AREA_SIMPLIFICATION_TOLERANCE = 0.01  # degrees
 
 # Scores given for metadata matches (relative importance)
 SCORE_TYPES = {
@@ -38,6 +60,36 @@ SCORE_TYPES = {
     'utc_offset': .5
 }
 
+# Years covered by the precomputed UTC offset to time zones table and the file it is saved to
+TIME_ZONE_TABLE_YEARS = (2010, 2030)
+TIME_ZONE_TABLE_FILE = os.path.join('output', 'time_zones', 'offset_table.json')
+
+# Languages of the tweets that are analyzed, e.g. ('en', 'id'). None analyzes all languages with
+# tags in input/tags.txt. Resources of a language are only loaded when a tweet in it is analyzed
+LANGUAGES = None
+
+# Number of analyzed tweet texts that are cached for retweets and copies
+TEXT_CACHE_SIZE = 100000
+
+# File with the most frequent user locations resolved in advance (see geotag.user_locations)
+# and the number of user locations it holds
+USER_LOCATIONS_FILE = os.path.join('output', 'user_locations', 'user_locations.json')
+N_PRERESOLVED_USER_LOCATIONS = 100000
+
+# File with the prebuilt state of the analyzer, and the input files and preprocessing steps
+# (see preprocessing.STEPS) it is built from. The state is rebuilt when one of the files changes,
+# one of the steps is run again or an update of the gazetteer is applied
+ANALYZER_STATE_FILE = os.path.join('output', 'analyzer', 'state.pickle')
+ANALYZER_STATE_INPUT_FILES = (
+    'input/tags.txt',
+    'input/tables/languages.xlsx',
+    'input/tables/timezones_per_continent.xlsx'
+)
+ANALYZER_STATE_INPUT_STEPS = (
+    'countries', 'continents', 'simplified_areas', 'adm1', 'geonames', 'geonames_time_zones',
+    'administrative_parents', 'alternate_names', 'time_zone_map', 'time_zones_per_country'
+)
+
 # Name of the PostgreSQL database (lowercase)
 POSTGRESQL_DB = 'taggs'
 # Name of the toponym resolution table
@@ -52,11 +104,11 @@ TOPONYM_INDEX = 'toponyms'
 # Update tweets in the database with their locations (flag for testing purposes)
 UPDATE = False
 
-# Connect to databases
-es_tweets = Elastic()
+# Connections to the databases, which are opened when first used
+es_tweets = function.Lazy(Elastic)
 es_toponyms = es_tweets
-pg_Geotag = PostgreSQL(POSTGRESQL_DB)
-pg = PostgreSQL(POSTGRESQL_DB)
+pg_Geotag = function.Lazy(PostgreSQL, POSTGRESQL_DB)
+pg = function.Lazy(PostgreSQL, POSTGRESQL_DB)
 
 
 # The functions below are meant to connect to your database.
@@ -140,15 +192,21 @@ class GeotagCustom:
     def analyze_tweets(self, query):
         """Function that analyzes all tweets using analyze_tweet, it is possible to change the number
         of cores used for this function"""
+        start = time.perf_counter()
         tweets = es_tweets.scroll_through(index=TWEETS_INDEX, body=query, size=1000, source=True)
 
-        loc_tweets = dict(
-            [
-                (item[0], item[1]) for item in [
-                    self.tweet_analyzer.analyze_tweet(tweet)
-                    for tweet in tweets
-                ] if item is not None
-            ]
-        )
-
+        loc_tweets = {}
+        n_tweets = 0
+        # The user locations of each page are resolved in one batch
+        for page in function.chunker(tweets, 1000):
+            page = list(page)
+            n_tweets += len(page)
+            self.tweet_analyzer.prefetch_user_locations(page)
+            for tweet in page:
+                item = self.tweet_analyzer.analyze_tweet(tweet)
+                if item is not None:
+                    loc_tweets[item[0]] = item[1]
+
+        print(f"Analyzed {n_tweets} tweets ({len(loc_tweets)} with potential locations) in {time.perf_counter() - start:.1f}s")
+        self.tweet_analyzer.print_area_metrics()
         return loc_tweets
@@ -1,20 +1,35 @@
+import sys
 import time
+import itertools
+from datetime import date, timedelta
+from operator import itemgetter
 import xml.etree.ElementTree as ET
 import requests
 import os
 import csv
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from requests.packages.urllib3.exceptions import MaxRetryError
 
 from db.postgresql import PostgreSQL
 from IO import files
-from methods import shapefiles, function
+from methods import shapefiles, function, geo
+import relations
+import steps
 
 from config import (
     TOPONYM_INDEX,
     GEONAMES_USERNAME,
     REFRESH_GEONAMES_TABLES,
+    AREA_SIMPLIFICATION_TOLERANCES,
     GEONAMES_DIR,
+    GEONAMES_UPDATES_DIR,
+    SPATIAL_JOIN_PROCESSES,
+    GEONAMES_CHILDREN_DIR,
+    GEONAMES_OFFLINE,
+    GEONAMES_REQUESTS_PER_HOUR,
+    GEONAMES_THREADS,
+    USER_LOCATIONS_FILE,
     POSTGRESQL_DB,
     es_toponyms
 )
@@ -23,6 +38,56 @@ from config import (
 pd.options.mode.chained_assignment = None
 SRID = 4326  # WGS84
 
+# Columns of the geonames dumps (allCountries and the daily modifications) and the ones used
+GEONAMES_COLUMNS_IN = ['geonameid', 'name', 'asciiname', 'alternatenames', 'latitude', 'longitude', 'feature_class', 'feature_code', 'country', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code', 'population', 'elevation', 'dem', 'time_zone', 'modification_date']
+GEONAMES_COLUMNS_OUT = ['geonameid', 'name', 'feature_class', 'feature_code', 'country', 'population', 'longitude', 'latitude']
+GEONAMES_DTYPES = {
+    'geonameid': int,
+    'name': object,
+    'asciiname': object,
+    'alternatenames': object,
+    'latitude': object,
+    'longitude': object,
+    'feature_class': object,
+    'feature_code': object,
+    'country': object,
+    'cc2': object,
+    'admin1_code': object,
+    'admin2_code': object,
+    'admin3_code': object,
+    'admin4_code': object,
+    'population': float,
+    'elevation': float,
+    'dem': float,
+    'time_zone': object,
+}
+# Columns loaded into the geonames table
+GEONAMES_COLUMNS = ['geonameid', 'name', 'feature_class', 'feature_code', 'country_geonameid', 'population', 'longitude', 'latitude', 'full_name']
+# Feature codes of the locations in the geonames table, besides the locations in the adm1 table
+GEONAMES_FEATURE_CODES = set([
+    # Towns
+    'PPL', 'PPLA', 'PPLA2', 'PPLA3', 'PPLA4', 'PPLC', 'PPLCH', 'PPLF', 'PPLG', 'PPLH', 'PPLL', 'PPLQ', 'PPLR', 'PPLS', 'PPLW', 'PPLX', 'STLMT',
+    # Administrative areas
+    'PCLI', 'ADM1', 'ADM2', 'ADM1H', 'ADM2H',
+    'CONT'
+])
+
+# Columns of the alternate names dumps (alternateNames and the daily modifications) and the ones used
+ALTERNATE_NAMES_COLUMNS_IN = ['alternateNameId', 'geonameid', 'isolanguage', 'alternate_name', 'isPreferredName', 'isShortName', 'isColloquial', 'isHistoric']
+ALTERNATE_NAMES_COLUMNS_OUT = ['alternateNameId', 'geonameid', 'isolanguage', 'alternate_name']
+ALTERNATE_NAMES_DTYPES = {
+    'alternateNames': object,
+    'geonameid': int,
+    'isolanguage': object,
+    'alternate name': object,
+    'isPreferredName': object,
+    'isShortName': object,
+    'isColloquial': object,
+    'isHistoric': object,
+}
+# Columns loaded into the alternate_names table
+ALTERNATE_NAMES_COLUMNS = ['alternateNameId', 'geonameid', 'isolanguage', 'alternate_name', 'full_name']
+
 
 class Preprocess(PostgreSQL):
     def __init__(self):
@@ -30,153 +95,191 @@ class Preprocess(PostgreSQL):
         PostgreSQL.__init__(self, POSTGRESQL_DB)
         PostgreSQL.initialize_postgis(self)
 
-    def index_unique_names(self):
+    def index_unique_names(self, n_threads=4, size=1000, names=None):
         """This function gets all unique names from the geonames and alternative names table, collects
-        all some data from these databases and indexes all data to elasticsearch ready for querying"""
-
-        def get_toponyms(names):
-            # Check if the index exists. If it does not exist, the database is emtpy and we need to
-            # index all names. Otherwise we first query the database to find all names
-            # already indexed and only index the names not yet indexed.
-            if es_toponyms.indices.exists(index=TOPONYM_INDEX):
-                names_no_exist = []
-                for chunk in function.chunker(names, 10000):
-                    documents = es_toponyms.mget(
-                        index=TOPONYM_INDEX,
-                        doc_type='unique_name',
-                        body={'ids': chunk}
-                        )['docs']
-                    names_no_exist.extend([doc['_id'] for doc in documents if doc['found'] is False])
-            else:
-                names_no_exist = names
-            if names_no_exist:
-                n_names = len(names_no_exist)
-                for i, name in enumerate(names_no_exist, start=1):
-
-                    if i % 100 == 0:
-                        print("Indexing unique names ({}/{})".format(i, n_names), end="\r")
-                    if es_toponyms.exists(index='toponyms', doc_type='unique_name', id=name):
-                        continue
-
-                    self.cur.execute("""
-                        SELECT geonameid
-                        FROM geonames
-                        WHERE name='{}'
-                    """.format(name.replace("'", "''")))
-                    geonameids = [geonameid for geonameid, in self.cur.fetchall()]
-
-                    abbreviations = {
-                        geonameid: []
-                        for geonameid in geonameids
-                    }
-
-                    languages = {
-                        geonameid: ['general']
-                        for geonameid in geonameids
-                    }
+        all some data from these databases and indexes all data to elasticsearch ready for querying.
+        The static relations between the locations bearing a name (see relations) are stored with
+        the locations, so that the analyzer does not have to derive these for each tweet.
+
+        The locations of all names are retrieved with a single grouped query, which is streamed
+        ordered by name, and indexed by n_threads in parallel. If the index already exists (e.g.
+        after an interrupted run), only the names not yet indexed are indexed.
+
+        If names is given, only the documents of these names are (re)indexed, and the documents
+        of the names no longer borne by any location are deleted (see update_gazetteer)."""
+        self.cur.execute("SELECT geonameid FROM adm1")
+        adm1_geonameids = set(geonameid for geonameid, in self.cur.fetchall())
+        self.cur.execute("SELECT geonameid, continents FROM countries")
+        country_2_continent = {
+            country: [int(c) for c in continent.split(',')]
+            for country, continent in self.cur.fetchall()
+        }
 
-                    self.cur.execute("""
-                        SELECT geonameid, isolanguage, full_name
-                        FROM alternate_names
-                        WHERE alternate_name='{}'
-                    """.format(name.replace("'", "''")))
-
-                    for geonameid, isolanguage, full_name in self.cur.fetchall():
-                        if not isolanguage:
-                            continue
-
-                        if geonameid not in languages:
-                            languages[geonameid] = [isolanguage]
-                        else:
-                            languages[geonameid].append(isolanguage)
-                        if geonameid not in abbreviations:
-                            abbreviations[geonameid] = []
-                        if isolanguage == 'abbr':
-                            abbreviations[geonameid].append(full_name)
-
-                    if languages:
-
-                        ids = '(' + ', '.join([str(geonameid) for geonameid in languages.keys()]) + ')'
-
-                        self.cur.execute(f"""SELECT
-                                geonameid,
-                                ST_X(location),
-                                ST_Y(location),
-                                population,
-                                feature_code,
-                                feature_class,
-                                country_geonameid,
-                                adm1_geonameid,
-                                time_zone,
-                                (
-                                    SELECT COUNT(*)
-                                    FROM alternate_names
-                                    WHERE geonames.geonameid = alternate_names.geonameid
-                                ) AS translations
-                            FROM geonames
-                            WHERE geonameid IN {ids}""")
-
-                        locations = [
-                                {
-                                     'geonameid': geonameid,
-                                     'iso-language': languages[geonameid],
-                                     'coordinates': (longitude, latitude),
-                                     'time_zone': time_zone,
-                                     'population': population,
-                                     'country_geonameid': country_geonameid,
-                                     'adm1_geonameid': adm1_geonameid,
-                                     'feature_code': feature_code,
-                                     'feature_class': feature_class,
-                                     'translations': translations,
-                                     'abbreviations': abbreviations[geonameid]
-                                }
-                                for geonameid, longitude, latitude, population, feature_code, feature_class, country_geonameid, adm1_geonameid, time_zone, translations in self.cur.fetchall()
-                                if languages[geonameid] is not None
-                        ]
-
-                        if locations:
-                            body = {
-                                'locations': locations,
-                                '_index': TOPONYM_INDEX,
-                                '_type': 'unique_name',
-                                '_id': name,
-                                '_op_type': 'index'
-                            }
-                            yield body
-
-            # Print the final number ones more without \r to that it is not overwritten by the next print.
-            print(f"Indexing unique names ({n_names}/{n_names})")
-
-        # # Retrieve all distinct names from the geonames and alternative names table
-        self.cur.execute("""
-            SELECT DISTINCT name
-            FROM
-            (
-                SELECT name FROM geonames
+        if names is None:
+            name_condition, alternate_name_condition, location_condition = 'TRUE', 'TRUE', 'TRUE'
+        else:
+            names = set(names)
+            self.cur.execute("DROP TABLE IF EXISTS update_names")
+            self.cur.execute("CREATE TEMPORARY TABLE update_names (name VARCHAR(400) PRIMARY KEY)")
+            self.copy_rows('update_names', ['name'], ((name, ) for name in names))
+            name_condition = "name IN (SELECT name FROM update_names)"
+            alternate_name_condition = "alternate_name IN (SELECT name FROM update_names)"
+            location_condition = f"""geonameid IN (
+                SELECT geonameid FROM geonames WHERE {name_condition}
+                UNION
+                SELECT geonameid FROM alternate_names WHERE {alternate_name_condition}
+            )"""
+
+        # The number of translations of each location, counted once rather than for each name
+        self.cur.execute("DROP TABLE IF EXISTS translations")
+        self.cur.execute(f"""
+            CREATE TEMPORARY TABLE translations AS
+            SELECT geonameid, COUNT(*) AS n
+            FROM alternate_names
+            WHERE {location_condition}
+            GROUP BY geonameid
+        """)
+
+        # One row for each name and location bearing that name. The name of a location in
+        # the geonames table is in the language 'general'. Alternate names without a language
+        # are not used.
+        rows = self.stream(f"""
+            SELECT
+                names.name,
+                geonames.geonameid,
+                array_agg(names.isolanguage ORDER BY names.isolanguage <> 'general'),
+                array_agg(names.full_name) FILTER (WHERE names.isolanguage = 'abbr'),
+                ST_X(geonames.location),
+                ST_Y(geonames.location),
+                geonames.population,
+                geonames.feature_code,
+                geonames.feature_class,
+                geonames.country_geonameid,
+                geonames.adm1_geonameid,
+                geonames.time_zone,
+                COALESCE(translations.n, 0)
+            FROM (
+                SELECT name, geonameid, 'general' AS isolanguage, NULL AS full_name
+                FROM geonames
+                WHERE {name_condition}
                 UNION ALL
-                SELECT alternate_name FROM alternate_names
-            ) AS x""")
+                SELECT alternate_name, geonameid, isolanguage, full_name
+                FROM alternate_names
+                WHERE isolanguage IS NOT NULL AND isolanguage <> '' AND {alternate_name_condition}
+            ) AS names
+            JOIN geonames ON geonames.geonameid = names.geonameid
+            LEFT JOIN translations ON translations.geonameid = geonames.geonameid
+            GROUP BY names.name, geonames.geonameid, translations.n
+            ORDER BY names.name
+        """)
+
+        indexed_names = set()
+
+        def get_documents(rows):
+            for name, name_rows in itertools.groupby(rows, key=itemgetter(0)):
+                indexed_names.add(name)
+                locations = [
+                    {
+                         'geonameid': geonameid,
+                         'iso-language': languages,
+                         'coordinates': (longitude, latitude),
+                         'time_zone': time_zone,
+                         'population': population,
+                         'country_geonameid': country_geonameid,
+                         'adm1_geonameid': adm1_geonameid,
+                         'feature_code': feature_code,
+                         'feature_class': feature_class,
+                         'translations': translations,
+                         'abbreviations': abbreviations or []
+                    }
+                    for _, geonameid, languages, abbreviations, longitude, latitude, population, feature_code, feature_class, country_geonameid, adm1_geonameid, time_zone, translations in name_rows
+                ]
+                for loc in locations:
+                    loc['type'] = relations.location_type(loc['feature_code'], loc['geonameid'], adm1_geonameids)
+                    loc['continents'] = country_2_continent.get(loc['country_geonameid'], [])
+                # Locations without a type are never considered by the analyzer
+                dominated_by = relations.dominated_by(
+                    [loc for loc in locations if loc['type'] is not None],
+                    country_2_continent
+                )
+                for loc in locations:
+                    loc['dominated_by'] = dominated_by.get(loc['geonameid'], [])
+
+                yield {
+                    'locations': locations,
+                    '_index': TOPONYM_INDEX,
+                    '_type': 'unique_name',
+                    '_id': name,
+                    '_op_type': 'index'
+                }
+
+        def skip_indexed(documents, index_exists):
+            # Skips the names that were already indexed by an earlier run
+            n_indexed, n_skipped = 0, 0
+            for chunk in function.chunker(documents, 10000):
+                chunk = list(chunk)
+                if index_exists:
+                    found = set(
+                        doc['_id'] for doc in es_toponyms.mget(
+                            index=TOPONYM_INDEX,
+                            doc_type='unique_name',
+                            body={'ids': [document['_id'] for document in chunk]},
+                            _source=False
+                        )['docs']
+                        if doc['found']
+                    )
+                else:
+                    found = set()
+                for document in chunk:
+                    if document['_id'] in found:
+                        n_skipped += 1
+                    else:
+                        n_indexed += 1
+                        yield document
+                print(f"Indexing unique names ({n_indexed} indexed, {n_skipped} already indexed)", end="\r")
+            # Print the final numbers once more without \r so that they are not overwritten by the next print.
+            print(f"Indexing unique names ({n_indexed} indexed, {n_skipped} already indexed)")
+
+        index_exists = es_toponyms.indices.exists(index=TOPONYM_INDEX)
+        if not index_exists:
+            es_toponyms.indices.create(index=TOPONYM_INDEX)
+        documents = skip_indexed(get_documents(rows), index_exists and names is None)
+
+        # The index is not refreshed while the names are indexed
+        es_toponyms.indices.put_settings(index=TOPONYM_INDEX, body={'index': {'refresh_interval': '-1'}})
+        try:
+            es_toponyms.parallel_bulk_operation(documents, size=size, n_threads=n_threads)
+        finally:
+            es_toponyms.indices.put_settings(index=TOPONYM_INDEX, body={'index': {'refresh_interval': '1s'}})
+            es_toponyms.indices.refresh(index=TOPONYM_INDEX)
+            self.cur.execute("DROP TABLE IF EXISTS translations")
+            self.cur.execute("DROP TABLE IF EXISTS update_names")
+            self.conn.commit()
 
-        toponyms_to_index = get_toponyms([name for name, in self.cur.fetchall()])
-        es_toponyms.bulk_operation(toponyms_to_index)
+        if names is not None:
+            for name in names - indexed_names:
+                es_toponyms.delete(index=TOPONYM_INDEX, doc_type='unique_name', id=name, ignore=404)
+            print(f"Deleted {len(names - indexed_names)} unique names")
 
-    def get_geonames(self, file, ext):
+    def get_geonames(self, file, ext, unzip=True):
         """This function downloads data from the geonames website and unzips if
-        neccesary. For more info see: http://download.geonames.org/export/dump/readme.txt"""
+        neccesary. For more info see: http://download.geonames.org/export/dump/readme.txt
+        With unzip=False a zip file is kept as it is, to be read with parse_table_chunks"""
         try:
             os.makedirs(GEONAMES_DIR)
         except OSError:
             pass
         file_path_wo_ext = os.path.join(GEONAMES_DIR, file)
-        if not os.path.exists(file_path_wo_ext + '.txt') or REFRESH_GEONAMES_TABLES:
+        file_path = file_path_wo_ext + '.' + ext
+        unzip = unzip and ext == 'zip'
+        if not os.path.exists(file_path_wo_ext + '.txt' if unzip else file_path) or REFRESH_GEONAMES_TABLES:
             print('Downloading {}'.format(file))
             url = 'http://download.geonames.org/export/dump/{}'.format(file + '.' + ext)
             print(f"\t{url}")
-            file_path = file_path_wo_ext + '.' + ext
             response = files.download_http(url, file_path)
             if response is False:
                 print('Error')
-            if ext == 'zip':
+            if unzip:
                 files.unzipper(file_path, GEONAMES_DIR)
                 os.remove(file_path)
 
@@ -187,6 +290,17 @@ class Preprocess(PostgreSQL):
         os.remove(file_path)
         return df[columns_out]
 
+    def parse_table_chunks(self, file_path, column_names, columns_out, dtypes, skiprows=0, chunksize=500000):
+        """Like parse_table, but for the large geonames dumps: reads the table directly from
+        the zip file in chunks of chunksize rows and yields these as pandas dataframes, so
+        that the table never has to fit in memory"""
+        file_path = os.path.join(GEONAMES_DIR, file_path)
+        with zipfile.ZipFile(file_path) as zf:
+            with zf.open(os.path.splitext(os.path.basename(file_path))[0] + '.txt') as f:
+                for df in pd.read_csv(f, sep='\t', header=None, names=column_names, dtype=dtypes, skiprows=skiprows, engine='c', keep_default_na=False, na_values=["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "N/A", "NULL", "NaN", "nan"], quoting=csv.QUOTE_NONE, usecols=columns_out, chunksize=chunksize):
+                    yield df[columns_out]
+        os.remove(file_path)
+
     def create_continent_table(self):
         """This function reads the continents shapefile and commits it to PostgreSQL"""
         self.cur.execute("select exists(select * from information_schema.tables where table_name='continents')")
@@ -263,6 +377,28 @@ class Preprocess(PostgreSQL):
 
             self.conn.commit()
 
+    def create_simplified_areas_table(self):
+        """This function stores the geometries of the countries and continents simplified
+        at each of AREA_SIMPLIFICATION_TOLERANCES, from which the analyzer loads a tier"""
+        self.cur.execute("select exists(select * from information_schema.tables where table_name='simplified_areas')")
+        if not self.cur.fetchone()[0]:
+            print("Creating simplified areas table")
+            self.cur.execute(f"""CREATE TABLE simplified_areas (
+                geonameid INTEGER,
+                tolerance DOUBLE PRECISION,
+                geom GEOMETRY(Geometry, {SRID}),
+                PRIMARY KEY (geonameid, tolerance)
+            )""")
+            for tolerance in AREA_SIMPLIFICATION_TOLERANCES:
+                for table in ('countries', 'continents'):
+                    self.cur.execute(f"""
+                        INSERT INTO simplified_areas (geonameid, tolerance, geom)
+                        SELECT geonameid, %s, ST_SimplifyPreserveTopology(geom, %s)
+                        FROM {table}
+                        WHERE geom IS NOT NULL
+                    """, (tolerance, tolerance))
+            self.conn.commit()
+
     def create_adm1_table(self):
         self.cur.execute("select exists(select * from information_schema.tables where table_name='adm1')")
         if not self.cur.fetchone()[0]:
@@ -312,25 +448,34 @@ class Preprocess(PostgreSQL):
                 ADD COLUMN adm1_geonameid INT
             """)
             print("Matching geonames with adm1 - this will take a long time")
+            self.match_administrative_parents()
             self.cur.execute("""
+                CREATE INDEX
+                IF NOT EXISTS geonames_adm1_geonameids
+                ON geonames (adm1_geonameid)
+            """)
+            self.conn.commit()
+
+    def match_administrative_parents(self, condition='TRUE', commit=True):
+        """Sets the adm1 of the geonames matching condition (all by default)"""
+        if SPATIAL_JOIN_PROCESSES:
+            self.join_geonames('adm1_geonameid', 'adm1', 'geonameid', 'INT', f"feature_code in ('PPL','PPLA','PPLA2','PPLA3','PPLA4','PPLC','PPLG','PPLR','PPLS','PPLX','STLMT') AND {condition}", commit)
+        else:
+            self.cur.execute(f"""
                 UPDATE geonames
                 SET adm1_geonameid = adm1.geonameid
                 FROM adm1
                 WHERE (ST_Within(geonames.location, adm1.geom) AND feature_code in ('PPL','PPLA','PPLA2','PPLA3','PPLA4','PPLC','PPLG','PPLR','PPLS','PPLX','STLMT'))
+                    AND {condition}
             """)
-            self.conn.commit()
-            self.cur.execute("""
-                UPDATE geonames
-                SET adm1_geonameid = adm2.adm1_parent
-                FROM adm2
-                WHERE adm2.adm2 = geonames.geonameid
-            """)
-            self.conn.commit()
-            self.cur.execute("""
-                CREATE INDEX
-                IF NOT EXISTS geonames_adm1_geonameids
-                ON geonames (adm1_geonameid)
-            """)
+        self.cur.execute(f"""
+            UPDATE geonames
+            SET adm1_geonameid = adm2.adm1_parent
+            FROM adm2
+            WHERE adm2.adm2 = geonames.geonameid
+                AND {condition}
+        """)
+        if commit:
             self.conn.commit()
 
     def find_time_zones(self):
@@ -342,40 +487,118 @@ class Preprocess(PostgreSQL):
         if not self.cur.fetchone()[0]:
             print("Matching geonames with time_zones")
             self.cur.execute("""ALTER TABLE geonames ADD COLUMN time_zone VARCHAR(40)""")
+            self.match_time_zones()
 
             self.cur.execute("""
+                CREATE INDEX
+                IF NOT EXISTS geonames_names
+                ON geonames (name)
+            """)
+            self.conn.commit()
+
+    def match_time_zones(self, condition='TRUE', commit=True):
+        """Sets the time zone of the geonames matching condition (all by default)"""
+        if SPATIAL_JOIN_PROCESSES:
+            self.join_geonames('time_zone', 'time_zones', 'name', 'VARCHAR(40)', condition, commit)
+        else:
+            self.cur.execute(f"""
                 UPDATE geonames
                 SET time_zone = time_zones.name
                 FROM time_zones
                 WHERE ST_Within(geonames.location, time_zones.geom)
+                    AND {condition}
             """)
+            if commit:
+                self.conn.commit()
+
+    def join_geonames(self, column, table, id_column, column_type, condition='TRUE', commit=True):
+        """Sets column of the geonames matching condition to id_column of the area in table
+        within which they lie, like the UPDATE with ST_Within, but joined in Python in
+        SPATIAL_JOIN_PROCESSES processes (see geo.spatial_join)"""
+        points = list(self.stream(f"""
+            SELECT geonameid, ST_X(location), ST_Y(location)
+            FROM geonames
+            WHERE location IS NOT NULL AND {condition}
+        """))
+        self.cur.execute(f"SELECT {id_column}, ST_AsBinary(geom) FROM {table} WHERE geom IS NOT NULL")
+        areas = [(id, bytes(wkb)) for id, wkb in self.cur.fetchall()]
+        joined = geo.spatial_join(points, areas, SPATIAL_JOIN_PROCESSES)
+
+        self.cur.execute("DROP TABLE IF EXISTS joined_geonames")
+        self.cur.execute(f"CREATE TEMPORARY TABLE joined_geonames (geonameid INT PRIMARY KEY, value {column_type})")
+        self.copy_rows('joined_geonames', ['geonameid', 'value'], joined.items(), commit=False)
+        self.cur.execute(f"""
+            UPDATE geonames
+            SET {column} = joined_geonames.value
+            FROM joined_geonames
+            WHERE geonames.geonameid = joined_geonames.geonameid
+        """)
+        self.cur.execute("DROP TABLE joined_geonames")
+        if commit:
             self.conn.commit()
 
-            self.cur.execute("""
-                CREATE INDEX
-                IF NOT EXISTS geonames_names
-                ON geonames (name)
-            """)
-            self.conn.commit()
+    def get_childs(self, geonameid, rate_limiter):
+        """Returns the geonameids of the children of a geonameid from the GeoNames web service.
+        The responses are cached in GEONAMES_CHILDREN_DIR. Returns None if the response is not
+        cached and GEONAMES_OFFLINE is set"""
+        file_path = os.path.join(GEONAMES_CHILDREN_DIR, f'{geonameid}.xml')
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                root = ET.fromstring(f.read())
+            return list(geoname.text for geoname in root.iter('geonameId'))
+        if GEONAMES_OFFLINE:
+            return None
 
-    def get_childs(self, geonameid):
         url = f"http://api.geonames.org/children?geonameId={geonameid}&username={GEONAMES_USERNAME}"
         while True:
+            rate_limiter.wait()
             try:
-                root = ET.fromstring(requests.get(url).content)
+                content = requests.get(url, timeout=60).content
+                root = ET.fromstring(content)
+            # No response, or not XML (e.g. the error page of a server error)
+            except (requests.exceptions.RequestException, ET.ParseError):
+                time.sleep(100)
+                continue
+            if root.tag != 'geonames':
+                time.sleep(100)
+                continue
+            status = root.find('status')
+            # The geonameid does not exist (11) or has no children (15), which is cached as
+            # no children
+            if status is None or status.get('value') in ('11', '15'):
                 break
-            except MaxRetryError:
+            # The hourly, daily or weekly limit of the account is exceeded, or the service
+            # is busy (13, 22)
+            if status.get('value') in ('13', '18', '19', '20', '22'):
+                print(f"GeoNames: {status.get('message')}")
                 time.sleep(100)
+            else:
+                raise ValueError(f"GeoNames: {status.get('message')}")
+
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(file_path + '.tmp', file_path)
         return list(geoname.text for geoname in root.iter('geonameId'))
 
     def get_children(self, geonameids):
+        """Returns the (child, parent) pairs of the geonameids, of which the children are
+        retrieved in GEONAMES_THREADS threads at no more than GEONAMES_REQUESTS_PER_HOUR"""
+        os.makedirs(GEONAMES_CHILDREN_DIR, exist_ok=True)
+        rate_limiter = function.RateLimiter(GEONAMES_REQUESTS_PER_HOUR / 3600)
         child_parents = set()
-        n = len(geonameids)
-        for i, geonameid in enumerate(geonameids, start=1):
-            print(f'{i}/{n}', end='\r')
-            for child in self.get_childs(geonameid):
-                child_parents.add((child, geonameid))
-        print(f'{i}/{n}')
+        n, n_missing = len(geonameids), 0
+        with ThreadPoolExecutor(GEONAMES_THREADS) as executor:
+            children = executor.map(lambda geonameid: self.get_childs(geonameid, rate_limiter), geonameids)
+            for i, (geonameid, childs) in enumerate(zip(geonameids, children), start=1):
+                print(f'{i}/{n}', end='\r')
+                if childs is None:
+                    n_missing += 1
+                    continue
+                for child in childs:
+                    child_parents.add((child, geonameid))
+        print(f'{n}/{n}')
+        if n_missing:
+            print(f"The children of {n_missing} geonameids are not in {GEONAMES_CHILDREN_DIR}")
         return list(child_parents)
 
     def get_adm1_children(self):
@@ -392,9 +615,7 @@ class Preprocess(PostgreSQL):
                     adm1_parent INT
                 )""")
 
-            query = """INSERT INTO adm2 (adm2, adm1_parent) VALUES {}"""
-            mogr = f"(%s, %s)"
-            self.commit_chunk(query, mogr, child_parents)
+            self.copy_rows('adm2', ['adm2', 'adm1_parent'], child_parents)
 
     def get_geoname_table(self, file_path, ext, columns_in, columns_out, skiprows=0):
         self.get_geonames(file_path, ext)
@@ -437,42 +658,27 @@ class Preprocess(PostgreSQL):
                 country_geonameid INT,
                 admin1_geonameid INT)
             """)
-            columns_in = ['geonameid', 'name', 'asciiname', 'alternatenames', 'latitude', 'longitude', 'feature_class', 'feature_code', 'country', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code', 'population', 'elevation', 'dem', 'time_zone', 'modification_date']
-            columns_out = ['geonameid', 'name', 'feature_class', 'feature_code', 'country', 'population', 'longitude', 'latitude']
-
-            self.get_geonames('allCountries', 'zip')
-            dtypes = {
-                'geonameid': int,
-                'name': object,
-                'asciiname': object,
-                'alternatenames': object,
-                'latitude': object,
-                'longitude': object,
-                'feature_class': object,
-                'feature_code': object,
-                'country': object,
-                'cc2': object,
-                'admin1_code': object,
-                'admin2_code': object,
-                'admin3_code': object,
-                'admin4_code': object,
-                'population': float,
-                'elevation': float,
-                'dem': float,
-                'time_zone': object,
-            }
-            features = self.parse_table('allCountries.txt', column_names=columns_in, columns_out=columns_out, dtypes=dtypes)
+            self.get_geonames('allCountries', 'zip', unzip=False)
+            chunks = self.parse_table_chunks('allCountries.zip', column_names=GEONAMES_COLUMNS_IN, columns_out=GEONAMES_COLUMNS_OUT, dtypes=GEONAMES_DTYPES)
+            self.copy_rows('geonames', GEONAMES_COLUMNS, self.select_geonames(chunks), points={'location': ('longitude', 'latitude')}, srid=SRID)
 
-            town_codes = set(['PPL', 'PPLA', 'PPLA2', 'PPLA3', 'PPLA4', 'PPLC', 'PPLCH', 'PPLF', 'PPLG', 'PPLH', 'PPLL', 'PPLQ', 'PPLR', 'PPLS', 'PPLW', 'PPLX', 'STLMT'])
-            adm_codes = set(['PCLI', 'ADM1', 'ADM2', 'ADM1H', 'ADM2H'])
-            other_codes = set(['CONT'])
+    def select_geonames(self, chunks):
+        """Generator that filters the locations used from chunks of a geonames table
+        and yields them as rows of GEONAMES_COLUMNS"""
+        self.cur.execute("""SELECT geonameid FROM adm1""")
+        adm1_codes = set(geonameid for geonameid, in self.cur.fetchall())
 
-            select_feature_codes = town_codes | adm_codes | other_codes
-            self.cur.execute("""SELECT geonameid FROM adm1""")
-            adm1_codes = set(geonameid for geonameid, in self.cur.fetchall())
+        self.cur.execute("""
+            SELECT ISO2, geonameid FROM countries
+        """)
+        ISO2_2_geonameid = {
+            ISO2: geonameid
+            for ISO2, geonameid in self.cur.fetchall()
+        }
 
+        for features in chunks:
             features = features[
-                (features['feature_code'].isin(select_feature_codes)) | features['geonameid'].isin(adm1_codes)
+                (features['feature_code'].isin(GEONAMES_FEATURE_CODES)) | features['geonameid'].isin(adm1_codes)
             ]
 
             features['full_name'] = features['name']
@@ -480,24 +686,10 @@ class Preprocess(PostgreSQL):
             features['longitude'] = pd.to_numeric(features['longitude'])
             features['latitude'] = pd.to_numeric(features['latitude'])
 
-            self.cur.execute("""
-                SELECT ISO2, geonameid FROM countries
-            """)
-            ISO2_2_geonameid = {
-                ISO2: geonameid
-                for ISO2, geonameid in self.cur.fetchall()
-            }
-
             # Map country ISO-code to geonameid
-            features['country'] = features['country'].map(ISO2_2_geonameid)
+            features['country_geonameid'] = features['country'].map(ISO2_2_geonameid)
 
-            query = """
-                INSERT INTO geonames (geonameid, name, feature_class, feature_code, country_geonameid, population, location, full_name)
-                VALUES {}
-            """
-            mogr = f"(%s, %s, %s, %s, %s, %s, ST_GeomFromText('POINT(%s %s)', {SRID}), %s)"
-            values = (value for i, value in features.iterrows())
-            self.commit_chunk(query, mogr, values)
+            yield from features[GEONAMES_COLUMNS].itertuples(index=False, name=None)
 
     def create_alternate_names_table(self):
         # Only execute if table does not exist
@@ -513,36 +705,11 @@ class Preprocess(PostgreSQL):
                 full_name VARCHAR(400)
             )""")
 
-            self.get_geonames('alternateNames', 'zip')
-            columns_in = ['alternateNameId', 'geonameid', 'isolanguage', 'alternate_name', 'isPreferredName', 'isShortName', 'isColloquial', 'isHistoric']
-            columns_out = ['alternateNameId', 'geonameid', 'isolanguage', 'alternate_name']
-            dtypes = {
-                'alternateNames': object,
-                'geonameid': int,
-                'isolanguage': object,
-                'alternate name': object,
-                'isPreferredName': object,
-                'isShortName': object,
-                'isColloquial': object,
-                'isHistoric': object,
-            }
-            alternate_names = self.parse_table('alternateNames.txt', column_names=columns_in, columns_out=columns_out, dtypes=dtypes)
-            alternate_names = alternate_names[~alternate_names['isolanguage'].isin(['link', 'post'])]
-
-            # Use only rows with geonameids in geonames table. Others we don't need
-            self.cur.execute("SELECT geonameid FROM geonames")
-            geonameids = set(id for id, in self.cur.fetchall())
-            alternate_names = alternate_names[alternate_names['geonameid'].isin(geonameids)]
-
-            # Set name to lowercase
-            alternate_names['full_name'] = alternate_names['alternate_name']
-            alternate_names['alternate_name'] = alternate_names['alternate_name'].str.lower()
+            self.get_geonames('alternateNames', 'zip', unzip=False)
 
             # Commit to database
-            query = "INSERT INTO alternate_names (alternateNameId, geonameid, isolanguage, alternate_name, full_name) VALUES {}"
-            mogr = "(%s, %s, %s, %s, %s)"
-            values = (value for i, value in alternate_names.iterrows())
-            self.commit_chunk(query, mogr, values)
+            chunks = self.parse_table_chunks('alternateNames.zip', column_names=ALTERNATE_NAMES_COLUMNS_IN, columns_out=ALTERNATE_NAMES_COLUMNS_OUT, dtypes=ALTERNATE_NAMES_DTYPES)
+            self.copy_rows('alternate_names', ALTERNATE_NAMES_COLUMNS, self.select_alternate_names(chunks))
 
             # Create index for faster query. We need that later
             self.cur.execute("""CREATE INDEX
@@ -553,6 +720,151 @@ class Preprocess(PostgreSQL):
                 ON alternate_names (geonameid)""")
             self.conn.commit()
 
+    def select_alternate_names(self, chunks):
+        """Generator that filters the alternate names used from chunks of an alternate names
+        table and yields them as rows of ALTERNATE_NAMES_COLUMNS"""
+        self.cur.execute("SELECT geonameid FROM geonames")
+        geonameids = set(id for id, in self.cur.fetchall())
+
+        for alternate_names in chunks:
+            alternate_names = alternate_names[~alternate_names['isolanguage'].isin(['link', 'post'])]
+
+            # Use only rows with geonameids in geonames table. Others we don't need
+            alternate_names = alternate_names[alternate_names['geonameid'].isin(geonameids)]
+
+            # Set name to lowercase
+            alternate_names['full_name'] = alternate_names['alternate_name']
+            alternate_names['alternate_name'] = alternate_names['alternate_name'].str.lower()
+
+            yield from alternate_names[ALTERNATE_NAMES_COLUMNS].itertuples(index=False, name=None)
+
+    def get_update_file(self, file):
+        """Returns the path of a daily geonames update file, downloaded from the geonames website or,
+        if GEONAMES_UPDATES_DIR is set, taken from that directory (e.g. a directory with fixtures).
+        Returns None if the file is not available"""
+        if GEONAMES_UPDATES_DIR:
+            file_path = os.path.join(GEONAMES_UPDATES_DIR, file)
+            return file_path if os.path.exists(file_path) else None
+        updates_dir = os.path.join(GEONAMES_DIR, 'updates')
+        os.makedirs(updates_dir, exist_ok=True)
+        file_path = os.path.join(updates_dir, file)
+        if not os.path.exists(file_path):
+            print('Downloading {}'.format(file))
+            if files.download_http('http://download.geonames.org/export/dump/{}'.format(file), file_path + '.tmp') is False:
+                return None
+            os.replace(file_path + '.tmp', file_path)
+        return file_path
+
+    def parse_update_file(self, file_path, column_names, columns_out, dtypes):
+        """Parses a daily geonames update file and returns it as a pandas dataframe. Only the
+        first len(column_names) columns are read, as newer files can have more columns"""
+        if os.path.getsize(file_path) == 0:
+            return pd.DataFrame(columns=columns_out)
+        df = pd.read_csv(file_path, sep='\t', header=None, names=column_names, usecols=range(len(column_names)), dtype=dtypes, engine='c', keep_default_na=False, na_values=["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "N/A", "NULL", "NaN", "nan"], quoting=csv.QUOTE_NONE)
+        return df[columns_out]
+
+    def get_names(self, geonameids):
+        """Returns the names (including alternate names) of the geonameids"""
+        self.cur.execute("""
+            SELECT name FROM geonames WHERE geonameid = ANY(%s)
+            UNION
+            SELECT alternate_name FROM alternate_names WHERE geonameid = ANY(%s)
+        """, (geonameids, geonameids))
+        return set(name for name, in self.cur.fetchall())
+
+    def apply_update(self, day):
+        """Applies the geonames updates of a day to the geonames and alternate_names tables and
+        reindexes the unique names of the locations changed. Returns False if the update files
+        of the day are not available.
+
+        The tables are changed in one transaction, in which the day is recorded together with
+        the names to reindex (before and after the update) in the geonames_update_names table.
+        These are reindexed after the transaction (see reindex_update_names).
+
+        Locations that only become part of the geonames table by an update (e.g. a new feature
+        code) only get the alternate names added on or after that day."""
+        file_paths = {
+            file: self.get_update_file(f'{file}-{day.isoformat()}.txt')
+            for file in ('modifications', 'deletes', 'alternateNamesModifications', 'alternateNamesDeletes')
+        }
+        missing = [file for file, file_path in file_paths.items() if file_path is None]
+        if missing:
+            print(f"GeoNames updates of {day} not available: {', '.join(missing)}")
+            return False
+        print(f"Applying GeoNames updates of {day}")
+
+        modifications = self.parse_update_file(file_paths['modifications'], GEONAMES_COLUMNS_IN, GEONAMES_COLUMNS_OUT, GEONAMES_DTYPES)
+        deletes = self.parse_update_file(file_paths['deletes'], ['geonameid', 'name', 'comment'], ['geonameid'], {'geonameid': int})
+        alternate_names_modifications = self.parse_update_file(file_paths['alternateNamesModifications'], ALTERNATE_NAMES_COLUMNS_IN, ALTERNATE_NAMES_COLUMNS_OUT, ALTERNATE_NAMES_DTYPES)
+        alternate_names_deletes = self.parse_update_file(file_paths['alternateNamesDeletes'], ['alternateNameId', 'geonameid', 'comment'], ['alternateNameId', 'geonameid'], {'alternateNameId': int, 'geonameid': int})
+
+        geonameids = [int(geonameid) for geonameid in set(modifications['geonameid']) | set(deletes['geonameid'])]
+        alternate_name_ids = [int(id) for id in set(alternate_names_modifications['alternateNameId']) | set(alternate_names_deletes['alternateNameId'])]
+        # All locations of which the names or the data in the toponym index may change
+        changed = list(set(geonameids) | set(alternate_names_modifications['geonameid']) | set(alternate_names_deletes['geonameid']))
+        changed = [int(geonameid) for geonameid in changed]
+        names = self.get_names(changed)
+
+        # Modified locations are deleted and inserted again if they are still used
+        self.cur.execute("DELETE FROM geonames WHERE geonameid = ANY(%s)", (geonameids, ))
+        self.copy_rows('geonames', GEONAMES_COLUMNS, self.select_geonames([modifications]), points={'location': ('longitude', 'latitude')}, srid=SRID, commit=False)
+        self.match_time_zones(f"geonames.geonameid = ANY(ARRAY{geonameids}::INT[])", commit=False)
+        self.match_administrative_parents(f"geonames.geonameid = ANY(ARRAY{geonameids}::INT[])", commit=False)
+
+        # Likewise for the alternate names, including those of locations no longer in the geonames table
+        self.cur.execute("DELETE FROM alternate_names WHERE alternateNameId = ANY(%s)", (alternate_name_ids, ))
+        self.cur.execute("""
+            DELETE FROM alternate_names
+            WHERE geonameid = ANY(%s)
+                AND geonameid NOT IN (SELECT geonameid FROM geonames)
+        """, (geonameids, ))
+        self.copy_rows('alternate_names', ALTERNATE_NAMES_COLUMNS, self.select_alternate_names([alternate_names_modifications]), commit=False)
+
+        names |= self.get_names(changed)
+        self.cur.execute("INSERT INTO geonames_update_names (name) SELECT unnest(%s::TEXT[]) ON CONFLICT DO NOTHING", (list(names), ))
+        self.cur.execute("INSERT INTO geonames_updates (day) VALUES (%s) ON CONFLICT DO NOTHING", (day, ))
+        self.conn.commit()
+
+        self.reindex_update_names()
+        return True
+
+    def reindex_update_names(self):
+        """Reindexes the unique names recorded by apply_update and clears them, so that
+        reindexing continues after an interruption"""
+        self.cur.execute("SELECT name FROM geonames_update_names")
+        names = set(name for name, in self.cur.fetchall())
+        if names:
+            self.index_unique_names(names=names)
+        self.cur.execute("DELETE FROM geonames_update_names WHERE name = ANY(%s)", (list(names), ))
+        self.conn.commit()
+
+    def update_gazetteer(self, start=None, end=None):
+        """Applies the daily geonames updates (see apply_update) from start to end, which are by
+        default the day after the last update applied and yesterday. The days applied are recorded
+        in the geonames_updates table, so that an interrupted update continues where it stopped.
+        The files derived from the gazetteer are removed, as they are out of date after an update
+        (the analyzer state is rebuilt by the analyzer itself)"""
+        self.cur.execute("CREATE TABLE IF NOT EXISTS geonames_updates (day DATE PRIMARY KEY)")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS geonames_update_names (name VARCHAR(400) PRIMARY KEY)")
+        self.cur.execute("SELECT MAX(day) FROM geonames_updates")
+        last, = self.cur.fetchone()
+        self.conn.commit()
+        # Names of an update that was interrupted while reindexing
+        self.reindex_update_names()
+        if end is None:
+            end = date.today() - timedelta(days=1)
+        if start is None:
+            start = last + timedelta(days=1) if last else end
+
+        day = start
+        while day <= end:
+            if not self.apply_update(day):
+                break
+            if os.path.exists(USER_LOCATIONS_FILE):
+                print(f"Removing {USER_LOCATIONS_FILE}, run geotag.user_locations to resolve the user locations again")
+                os.remove(USER_LOCATIONS_FILE)
+            day += timedelta(days=1)
+
     def create_time_zone_table(self):
         # self.cur.execute("DROP TABLE IF EXISTS time_zones")
         self.cur.execute("select exists(select * from information_schema.tables where table_name='time_zones')")
@@ -588,9 +900,7 @@ class Preprocess(PostgreSQL):
                 reader = csv.reader(f)
                 tz_map = [(row[0], row[1]) for row in reader]
 
-            query = "INSERT INTO time_zone_map (twitter_name, tz_name) VALUES {}"
-            mogr = "(%s, %s)"
-            self.commit_chunk(query, mogr, tz_map)
+            self.copy_rows('time_zone_map', ['twitter_name', 'tz_name'], tz_map)
             self.cur.execute("CREATE INDEX \
                 IF NOT EXISTS tz_geometry_idx \
                 ON time_zones \
@@ -610,10 +920,7 @@ class Preprocess(PostgreSQL):
             df = pd.read_table(timezones_table, sep='\t', comment='#', usecols=range(3), names=['ISO2', 'coordinates_tz', 'name'], keep_default_na=False, na_values=["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "N/A", "NULL", "NaN", "nan"])
             df.drop('coordinates_tz', axis=1, inplace=True)
 
-            query = "INSERT INTO time_zones_per_country (ISO2, name) VALUES {}"
-            mogr = "(%s, %s)"
-            values = (value for i, value in df.iterrows())
-            self.commit_chunk(query, mogr, values, 100)
+            self.copy_rows('time_zones_per_country', ['ISO2', 'name'], df)
 
     def get_most_common_words(self):
         self.cur.execute("""SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name='most_common_words')""")
@@ -636,26 +943,41 @@ class Preprocess(PostgreSQL):
                         if i == 10000:
                             break
 
-            query = "INSERT INTO most_common_words (n, language, word) VALUES {}"
-            mogr = "(%s, %s, %s)"
-            self.commit_chunk(query, mogr, words, 100)
+            self.copy_rows('most_common_words', ['n', 'language', 'word'], words)
+
+
+# The steps of the preprocessing with the steps they depend on and their outputs (see steps)
+STEPS = [
+    steps.Step('continents', Preprocess.create_continent_table, outputs=['continents']),
+    steps.Step('countries', Preprocess.create_country_table, outputs=['countries']),
+    steps.Step('simplified_areas', Preprocess.create_simplified_areas_table, ['continents', 'countries'], ['simplified_areas']),
+    steps.Step('adm1', Preprocess.create_adm1_table, outputs=['adm1']),
+    steps.Step('adm1_children', Preprocess.get_adm1_children, ['adm1'], ['adm2']),
+
+    steps.Step('time_zones', Preprocess.create_time_zone_table, outputs=['time_zones']),
+    steps.Step('time_zone_map', Preprocess.create_time_zone_map, ['time_zones'], ['time_zone_map']),
+    steps.Step('time_zones_per_country', Preprocess.create_timezones_per_country_table, outputs=['time_zones_per_country']),
+
+    steps.Step('geonames', Preprocess.create_geonames_table, ['countries', 'adm1'], ['geonames']),
+    steps.Step('geonames_time_zones', Preprocess.find_time_zones, ['geonames', 'time_zones'], ['geonames.time_zone']),
+    # Both update all geonames, so these do not run at the same time
+    steps.Step('administrative_parents', Preprocess.find_administrative_parents, ['geonames', 'adm1_children', 'geonames_time_zones'], ['geonames.adm1_geonameid']),
+    steps.Step('most_common_words', Preprocess.get_most_common_words, outputs=['most_common_words']),
+
+    steps.Step('alternate_names', Preprocess.create_alternate_names_table, ['geonames'], ['alternate_names']),
+    steps.Step(
+        'toponym_index', Preprocess.index_unique_names,
+        ['countries', 'adm1', 'administrative_parents', 'alternate_names'],
+        count=lambda pg: es_toponyms.count(index=TOPONYM_INDEX)['count'],
+        reset=lambda pg: es_toponyms.indices.delete(index=TOPONYM_INDEX, ignore=404)
+    ),
+]
 
 
 if __name__ == '__main__':
-    p = Preprocess()
-    p.create_continent_table()
-    p.create_country_table()
-    p.create_adm1_table()
-    p.get_adm1_children()
-
-    p.create_time_zone_table()
-    p.create_time_zone_map()
-    p.create_timezones_per_country_table()
-
-    p.create_geonames_table()
-    p.find_time_zones()
-    p.find_administrative_parents()
-    p.get_most_common_words()
-
-    p.create_alternate_names_table()
-    p.index_unique_names()
+    if sys.argv[1:2] == ['update']:
+        # python preprocessing.py update [start] [end], with dates as YYYY-MM-DD
+        Preprocess().update_gazetteer(*(date(*map(int, arg.split('-'))) for arg in sys.argv[2:4]))
+    else:
+        # python preprocessing.py [n_threads]
+        steps.StepRunner(Preprocess, STEPS).run(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
@@ -0,0 +1,102 @@
+"""Static relations between the locations in the gazetteer: the type of a location and
+whether two locations bearing the same name are family. These depend only on the
+gazetteer and are therefore computed when the toponym index is built (see
+Preprocess.index_unique_names), with the same functions as the analyzer uses."""
+from collections import defaultdict as dd
+
+# Feature codes of the locations used as towns
+TOWN_CODES = set(['PPL', 'PPLA', 'PPLA2', 'PPLA3', 'PPLA4', 'PPLC', 'PPLG', 'PPLR', 'PPLS', 'STLMT'])
+ADM1_CODES = set(['ADM1', 'ADM1H', 'ADM2', 'ADM2H'])
+
+# The size order of the administrative levels. Can be used for sorting
+# locations by its size.
+SIZE_ORDER = {
+    "continent": 0,
+    "country": 1,
+    "adm1": 2,
+    "town": 3
+}
+
+
+def location_type(feature_code, geonameid, adm1_geonameids):
+    """Returns the type (town, country, adm1 or continent) of a location, or None if
+    the location is none of these"""
+    if feature_code in TOWN_CODES:
+        return 'town'
+    if feature_code in ADM1_CODES or geonameid in adm1_geonameids:
+        return 'adm1'
+    if feature_code == 'PCLI':
+        return 'country'
+    if feature_code == 'CONT':
+        return 'continent'
+    return None
+
+
+def continents(loc, country_2_continent):
+    """Returns the continent(s) of the country of a location. These are stored with the
+    location in the toponym index, for older indices they are looked up"""
+    try:
+        return loc['continents']
+    except KeyError:
+        return country_2_continent.get(loc['country_geonameid'], [])
+
+
+def family_keys(loc, country_2_continent, consider_toponym_length=True, long_toponyms=True):
+    """Returns the keys under which a location is a parent and the keys under which it
+    is a child. Two locations are family (parent-child) if a parent key of one is a
+    child key of the other. long_toponyms is True if both toponyms have at least 7
+    characters"""
+    if loc['type'] == 'continent':
+        return [('continent', loc['geonameid'])], []
+    elif loc['type'] == 'country':
+        return (
+            [('country', loc['country_geonameid'])],
+            [('continent', continent) for continent in continents(loc, country_2_continent)]
+        )
+    elif loc['type'] == 'adm1':
+        if not consider_toponym_length:
+            parents = [('adm1', loc['geonameid']), ('adm1', loc['adm1_geonameid'])]
+        elif long_toponyms:
+            parents = [('adm1', loc['geonameid'])]
+        else:
+            parents = []
+        return parents, [('country', loc['country_geonameid'])]
+    else:
+        return [], [('country', loc['country_geonameid']), ('adm1', loc['adm1_geonameid'])]
+
+
+def index_family(locations, country_2_continent, consider_toponym_length=True, long_toponyms=True):
+    """Returns dictionaries with the locations for each parent key and for each child key
+    (see family_keys)"""
+    parents, children = dd(list), dd(list)
+    for loc in locations:
+        parent_keys, child_keys = family_keys(loc, country_2_continent, consider_toponym_length, long_toponyms)
+        for key in parent_keys:
+            parents[key].append(loc)
+        for key in child_keys:
+            children[key].append(loc)
+    return parents, children
+
+
+def family_duplicates(locations, country_2_continent):
+    """Yields the pairs of locations with the same name that are family, with the one
+    to keep first: the one with the highest number of translations in the geonames
+    database, or on a tie the largest location"""
+    parents, children = index_family(locations, country_2_continent, consider_toponym_length=False)
+    for key, childs in children.items():
+        for parent in parents.get(key, []):
+            for child in childs:
+                if child['translations'] > parent['translations']:
+                    yield child, parent
+                else:
+                    yield parent, child
+
+
+def dominated_by(locations, country_2_continent):
+    """Returns for each location the geonameids of the locations with the same name
+    that are family and are kept over it. A location is discarded as a duplicate if
+    any of these is among the potential locations of a toponym"""
+    dominators = {loc['geonameid']: set() for loc in locations}
+    for keep, discard in family_duplicates(locations, country_2_continent):
+        dominators[discard['geonameid']].add(keep['geonameid'])
+    return {geonameid: sorted(geonameids) for geonameid, geonameids in dominators.items()}
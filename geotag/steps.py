@@ -0,0 +1,143 @@
+"""Runs the preprocessing as steps with dependencies (see preprocessing.STEPS). The
+completion of a step is recorded in the preprocessing_steps table in a single
+transaction after the step has finished. A step that was not completed (e.g. after a
+crash) is run again after its outputs (tables and columns) are dropped, and so are the
+steps depending on it. Steps of which the dependencies are completed can run in
+parallel, each with its own connection."""
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Step:
+    def __init__(self, name, run, dependencies=(), outputs=(), count=None, reset=None):
+        """run is called with a connection (see StepRunner) and dependencies are the
+        names of the steps that must be completed first. outputs are the tables
+        ('table') and columns ('table.column') created by the step, which are dropped
+        before the step is run. The rows of these are counted when the step is completed,
+        unless count(connection) is given. A step that resumes its own work instead (e.g.
+        indexing) can give reset(connection), which is called before the step is run
+        after one of its dependencies was run"""
+        self.name = name
+        self.run = run
+        self.dependencies = list(dependencies)
+        self.outputs = list(outputs)
+        self.count = count
+        self.reset = reset
+
+
+class StepRunner:
+    def __init__(self, connect, steps):
+        """connect returns a new connection (a PostgreSQL instance)"""
+        self.connect = connect
+        self.steps = steps
+        self.pg = connect()
+        self.pg.cur.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name='preprocessing_steps')")
+        exists = self.pg.cur.fetchone()[0]
+        self.pg.cur.execute("""
+            CREATE TABLE IF NOT EXISTS preprocessing_steps (
+                name VARCHAR(100) PRIMARY KEY,
+                finished TIMESTAMP,
+                seconds DOUBLE PRECISION,
+                rows BIGINT
+            )
+        """)
+        self.pg.conn.commit()
+        if not exists:
+            self.adopt_existing()
+
+    def output_exists(self, output):
+        table, _, column = output.partition('.')
+        if column:
+            self.pg.cur.execute("SELECT EXISTS(SELECT * FROM information_schema.columns WHERE table_name=%s AND column_name=%s)", (table, column))
+        else:
+            self.pg.cur.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)", (table, ))
+        return self.pg.cur.fetchone()[0]
+
+    def adopt_existing(self):
+        """Records the steps of which all outputs exist as completed, so that a database
+        built before steps were recorded is not rebuilt"""
+        for step in self.steps:
+            if step.outputs and all(self.output_exists(output) for output in step.outputs):
+                print(f"Recording existing step {step.name} as completed")
+                self.pg.cur.execute("INSERT INTO preprocessing_steps (name, finished) VALUES (%s, %s)", (step.name, datetime.now()))
+        self.pg.conn.commit()
+
+    def completed(self):
+        self.pg.cur.execute("SELECT name FROM preprocessing_steps")
+        return set(name for name, in self.pg.cur.fetchall())
+
+    def count_rows(self, pg, step):
+        if step.count:
+            return step.count(pg)
+        n_rows = 0
+        for output in step.outputs:
+            table, _, column = output.partition('.')
+            pg.cur.execute(f"SELECT COUNT({column or '*'}) FROM {table}")
+            n_rows += pg.cur.fetchone()[0]
+        return n_rows
+
+    def run_step(self, step, reset):
+        """Runs a step with its own connection and records its completion. Returns the
+        run time in seconds and the number of rows"""
+        pg = self.connect()
+        pg.cur.execute("DELETE FROM preprocessing_steps WHERE name = %s", (step.name, ))
+        if reset and step.reset:
+            step.reset(pg)
+        # Outputs of an earlier, incomplete run
+        for output in reversed(step.outputs):
+            table, _, column = output.partition('.')
+            if column:
+                pg.cur.execute(f"ALTER TABLE IF EXISTS {table} DROP COLUMN IF EXISTS {column}")
+            else:
+                pg.cur.execute(f"DROP TABLE IF EXISTS {table}")
+        pg.conn.commit()
+
+        start = time.time()
+        step.run(pg)
+        seconds = time.time() - start
+        n_rows = self.count_rows(pg, step)
+
+        pg.cur.execute(
+            "INSERT INTO preprocessing_steps (name, finished, seconds, rows) VALUES (%s, %s, %s, %s)",
+            (step.name, datetime.now(), seconds, n_rows)
+        )
+        pg.conn.commit()
+        pg.conn.close()
+        return seconds, n_rows
+
+    def run(self, n_threads=1):
+        """Runs the steps not yet completed, with up to n_threads steps at the same time,
+        and prints the run time and number of rows of each step"""
+        completed = self.completed()
+        steps = {step.name: step for step in self.steps}
+        finished, rerun, report = set(), set(), {}
+        running = {}
+        with ThreadPoolExecutor(n_threads) as executor:
+            while len(finished) < len(steps):
+                for name, step in steps.items():
+                    if name in finished or name in running.values() or not all(dependency in finished for dependency in step.dependencies):
+                        continue
+                    reset = any(dependency in rerun for dependency in step.dependencies)
+                    if name in completed and not reset:
+                        finished.add(name)
+                        report[name] = ('completed before', None, None)
+                        break
+                    print(f"Running step {name}")
+                    rerun.add(name)
+                    running[executor.submit(self.run_step, step, reset)] = name
+                else:
+                    if not running:
+                        raise ValueError(f"Steps with unknown or circular dependencies: {', '.join(set(steps) - finished)}")
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        seconds, n_rows = future.result()
+                        finished.add(name)
+                        report[name] = ('run', seconds, n_rows)
+                        print(f"Finished step {name} in {seconds:.1f}s")
+
+        print(f"{'step':<30}{'status':<20}{'time (s)':>10}{'rows':>14}")
+        for name in steps:
+            status, seconds, n_rows = report[name]
+            print(f"{name:<30}{status:<20}{'' if seconds is None else round(seconds, 1):>10}{'' if n_rows is None else n_rows:>14}")
@@ -0,0 +1,142 @@
+from itertools import product
+
+import numpy as np
+
+from geotag import Geotag
+from geotag.config import (
+    SCORE_TYPES,
+    es_tweets
+)
+
+
+class ParameterSweep(Geotag):
+    """Evaluates a grid of thresholds, score weights and minimum populations on a
+    period of tweets. The tweets are analyzed only once, with the lowest minimum
+    populations of the grid. For each tweet the potential locations are stored with
+    the raw (0 or 1) metadata matches. Duplicate and family detection, which depend on
+    the set of potential locations, are redone for each combination of minimum populations,
+    but without hitting the databases again. The scores of all weights are computed at
+    once, and a location is only selected for the thresholds that change which locations
+    pass"""
+    def __init__(self, thresholds, min_populations_capitalized, min_populations_non_capitalized, score_types_grid, n_words, analysis_length):
+        self.thresholds = sorted(thresholds)
+        self.min_populations = list(product(min_populations_capitalized, min_populations_non_capitalized))
+        # Weights not given in a setting of the grid are taken from SCORE_TYPES
+        self.score_types_grid = [dict(SCORE_TYPES, **score_types) for score_types in score_types_grid]
+
+        Geotag.__init__(
+            self,
+            threshold=self.thresholds[0],
+            min_population_capitalized=min(min_populations_capitalized),
+            min_population_non_capitalized=min(min_populations_non_capitalized),
+            n_words=n_words,
+            analysis_length=analysis_length
+        )
+        self.tweet_analyzer.score_types = {score_type: 1 for score_type in SCORE_TYPES}
+        self.tweet_analyzer.raw_scores = True
+
+    def analyze_period(self, start, end):
+        """Analyze all tweets in the period and store the potential locations"""
+        print("analyzing: {} - {}".format(start, end))
+        self.candidates = self.analyze_tweets(
+            es_tweets.build_date_query(start, end)
+        )
+
+    def rescore(self, min_population_capitalized, min_population_non_capitalized):
+        """Return the analyzed tweets with the potential locations of the given minimum
+        populations. Duplicate and family detection are done as in TweetAnalyzer.analyze_tweet,
+        the metadata matches remain 0 or 1"""
+        analyzer = self.tweet_analyzer
+        tweets = {}
+        for ID, tweet in self.candidates.items():
+            tweet_toponyms = {}
+            for toponym, locations in tweet['toponyms'].items():
+                doc_locations = [
+                    dict(loc, family=0) for loc in locations.values()
+                    if loc['population'] >= (
+                        min_population_capitalized if loc['capitalized'] else min_population_non_capitalized
+                    )
+                ]
+                if not doc_locations:
+                    continue
+                doc_locations = analyzer.discard_family_duplicates(doc_locations, toponym)
+                if tweet_toponyms:
+                    analyzer.match_family(tweet_toponyms, toponym, doc_locations, 1)
+                tweet_toponyms[toponym] = {loc['geonameid']: loc for loc in doc_locations}
+            if tweet_toponyms:
+                tweets[ID] = dict(tweet, toponyms=tweet_toponyms)
+        return tweets
+
+    def sweep_scores(self, geonameids):
+        """Compute the scores of all potential locations of a toponym for all score weights
+        at once. Returns the scores of each location for each weight setting"""
+        geonameids = list(geonameids.items())
+        type_scores = [self.sum_type_scores(info) for geonameid, info in geonameids]
+        counts = np.array([[type_score[score_type][0] for score_type in SCORE_TYPES] for type_score in type_scores], dtype=float)
+        n = np.array([[type_score[score_type][1] for score_type in SCORE_TYPES] for type_score in type_scores], dtype=float)
+        weights = np.array([[score_types[score_type] for score_type in SCORE_TYPES] for score_types in self.score_types_grid], dtype=float)
+
+        # The matches are 0 or 1, thus the summed score is the number of matches times the weight
+        # (exact for weights such as 0.5 or 3). Shape: (weights, locations, score types)
+        weighted = weights[:, np.newaxis, :] * counts[np.newaxis, :, :]
+
+        for w in range(len(self.score_types_grid)):
+            toponym_scores = []
+            for i, (geonameid, info) in enumerate(geonameids):
+                toponym_scores.append(
+                    self.score_location(geonameid, info, {
+                        score_type: (weighted[w, i, j], n[i, j])
+                        for j, score_type in enumerate(SCORE_TYPES)
+                    })
+                )
+            yield toponym_scores
+
+    def select_location_thresholds(self, toponym, toponym_scores):
+        """Returns select_location of the toponym for each threshold. The resolved location only
+        depends on which locations pass the threshold, so these are computed for all thresholds
+        at once and select_location is only called for each distinct set of locations"""
+        avg_scores = np.array([score['avg_score'] for score in toponym_scores])
+        always = np.array([score['type'] in ('country', 'continent') for score in toponym_scores])
+        # Shape: (locations, thresholds)
+        passed = (avg_scores[:, np.newaxis] >= np.array(self.thresholds)) | always[:, np.newaxis]
+        # The thresholds are sorted, so thresholds that pass the same locations are consecutive
+        starts = np.flatnonzero(np.r_[True, (passed[:, 1:] != passed[:, :-1]).any(axis=0)])
+        ends = np.r_[starts[1:], len(self.thresholds)]
+        locations = []
+        for start, end in zip(starts, ends):
+            location = self.select_location(toponym, toponym_scores, self.thresholds[start])
+            for t in range(start, end):
+                locations.append(location and (location[0], dict(location[1])))
+        return locations
+
+    def evaluate(self):
+        """Yields the settings and the resolved locations of all tweets for each combination
+        of the grid"""
+        for min_population_capitalized, min_population_non_capitalized in self.min_populations:
+            self.tweets = self.rescore(min_population_capitalized, min_population_non_capitalized)
+            toponyms = self.tweets_to_toponyms()
+
+            # resolved[w][t] holds the resolved toponyms of weight setting w and threshold t
+            resolved = [[[] for threshold in self.thresholds] for score_types in self.score_types_grid]
+            for toponym, geonameids in toponyms.items():
+                for w, toponym_scores in enumerate(self.sweep_scores(geonameids)):
+                    for t, location in enumerate(self.select_location_thresholds(toponym, toponym_scores)):
+                        if location:
+                            ids, resolved_location = location
+                            resolved[w][t].append((toponym, ids, resolved_location))
+
+            for w, score_types in enumerate(self.score_types_grid):
+                for t, threshold in enumerate(self.thresholds):
+                    settings = {
+                        'threshold': threshold,
+                        'score_types': score_types,
+                        'min_population_capitalized': min_population_capitalized,
+                        'min_population_non_capitalized': min_population_non_capitalized
+                    }
+                    yield settings, self.assign_locations(resolved[w][t])
+
+    def run(self, start, end):
+        """Analyze the period once and return a list with the settings and resolved
+        locations for each combination of the grid"""
+        self.analyze_period(start, end)
+        return list(self.evaluate())
@@ -0,0 +1,75 @@
+"""Resolves the most frequent user locations of the tweets index in advance and saves
+them to USER_LOCATIONS_FILE, which TweetAnalyzer loads at startup. A small share of the
+distinct user locations accounts for most tweets, so most tweets then skip the parsing
+of the user location. Run again after the gazetteer or the tweets have changed.
+
+    python -m geotag.user_locations [n]
+"""
+import os
+import sys
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from geotag.analyze import TweetAnalyzer
+from methods import function
+from geotag.config import (
+    USER_LOCATIONS_FILE,
+    N_PRERESOLVED_USER_LOCATIONS,
+    TWEETS_INDEX,
+    es_tweets
+)
+
+
+def count_user_locations():
+    """Returns a Counter with the number of tweets for each user location"""
+    body = {
+        '_source': ['user.location'],
+        'query': {
+            'exists': {
+                'field': 'user.location'
+            }
+        }
+    }
+    n_tweets = es_tweets.n_hits(index=TWEETS_INDEX, doc_type='tweet', body={'query': body['query']})
+    tweets = es_tweets.scroll_through(index=TWEETS_INDEX, body=body, size=1000, source=False)
+    counts = Counter()
+    for i, tweet in enumerate(tweets):
+        if i % 10000 == 0:
+            print("Counting user locations: {}%".format(round((i+1) / n_tweets * 100, 1)), end="\r")
+        user_location = tweet['user'].get('location')
+        if user_location:
+            counts[user_location] += 1
+    print()
+    return counts
+
+
+def resolve_user_locations(n=N_PRERESOLVED_USER_LOCATIONS, n_threads=8, file_path=USER_LOCATIONS_FILE):
+    """Resolves the n most frequent user locations and saves them to file_path. The user
+    locations are resolved in batches (see TweetAnalyzer.find_user_locations), of which
+    n_threads are sent to the toponym index at once"""
+    counts = count_user_locations()
+    user_locations = [user_location for user_location, count in counts.most_common(n)]
+    n_tweets = sum(counts[user_location] for user_location in user_locations)
+    print(f"{len(user_locations)} user locations cover {n_tweets} of {sum(counts.values())} tweets")
+
+    analyzer = TweetAnalyzer(min_population_capitalized=1, min_population_non_capitalized=1, n_words=0)
+    resolved = {}
+    with ThreadPoolExecutor(n_threads) as executor:
+        for i, batch in enumerate(executor.map(analyzer.find_user_locations, function.chunker(user_locations, 1000)), start=1):
+            print(f"Resolving user locations: {min(i * 1000, len(user_locations))}/{len(user_locations)}", end="\r")
+            resolved.update(batch)
+    print()
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path + '.tmp', 'w') as f:
+        json.dump({
+            user_location: list(locations)
+            for user_location, locations in resolved.items()
+        }, f)
+    os.replace(file_path + '.tmp', file_path)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    resolve_user_locations(int(args[0]) if args else N_PRERESOLVED_USER_LOCATIONS)
@@ -1,13 +1,14 @@
 import math
 import datetime
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import pairwise_distances
 
 my_token_pattern = r"\w+(?:-\w+)+|[-+]?\d+[.,]?\d+|[#@]?\w+\b|[\U00010000-\U0010ffff\U0001F300-\U0001F64F\U0001F680-\U0001F6FF\u2600-\u26FF\u2700-\u27BF]|[.:()[],;?!*]{2,4}"
 
 
 def eliminate_near_duplicate_tweets(tweetsDF, distancemetric='cosine', debug=False, similarity_threshold=0.20, debug_threshold=1000, defaultfreqcut_off=2, n_jobs=1):
+    # scikit-learn is slow to import, therefore it is only imported when used
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import pairwise_distances
     start_time = datetime.datetime.now()
     if len(tweetsDF) > 1000:
         freqcutoff = int(math.log(len(tweetsDF)))
@@ -54,21 +55,21 @@ def eliminate_near_duplicate_tweets(tweetsDF, distancemetric='cosine', debug=Fal
     # If multiple tweets are similar, pick the oldest one and therefore, most likely the original one
     if 'date' in tweetsDF.columns:
         for clst in cluster_tuples2:
-            last_date = tweetsDF.ix[[i for i in clst]].sort_values(by='date').iloc[0]
-            one_index_per_duplicate_group.append(last_date._name)
+            last_date = tweetsDF.loc[[i for i in clst]].sort_values(by='date').iloc[0]
+            one_index_per_duplicate_group.append(last_date.name)
     else:
         for clst in cluster_tuples2:
             one_index_per_duplicate_group.append(clst[0])
 
     indexes_of_the_uniques = [i for i in tweetsDF.index if i not in duplicate_tweet_indexes]
 
-    unique_tweetsDF = tweetsDF.ix[[i for i in tweetsDF.index if i not in duplicate_tweet_indexes]+one_index_per_duplicate_group]  # +
+    unique_tweetsDF = tweetsDF.loc[[i for i in tweetsDF.index if i not in duplicate_tweet_indexes]+one_index_per_duplicate_group]  # +
 
     tweet_sets = []
     for i, ct in enumerate(cluster_tuples2):
         tweets = []
         for t_indx in ct:
-            tweets.append(tweetsDF['text'].ix[t_indx])
+            tweets.append(tweetsDF['text'].loc[t_indx])
         tweet_sets.append(tweets)
 
     return unique_tweetsDF
@@ -1,5 +1,7 @@
+import time
 import types
 import itertools
+import threading
 
 
 def in_range(start, end, value):
@@ -33,3 +35,36 @@ def find_duplicates(items, hash=True):
             else:
                 seen.append(x)
         return duplicates
+
+
+class Lazy:
+    """Proxy of an object that is only created (with create(*args)) when one of its
+    attributes is first used, such as a database connection"""
+    def __init__(self, create, *args):
+        self._create = create
+        self._args = args
+        self._object = None
+
+    def __getattr__(self, name):
+        # Special attributes (e.g. looked up by pickle or copy) do not create the object
+        if name.startswith('__') or name in ('_create', '_args', '_object'):
+            raise AttributeError(name)
+        if self._object is None:
+            self._object = self._create(*self._args)
+        return getattr(self._object, name)
+
+
+class RateLimiter:
+    """Limits the calls of wait() to rate per second, over all threads"""
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(self.next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
